@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Move generation benchmark.
+
+Runs the engine over the board and rack fixtures in files/benchmark.json
+and reports moves/sec, dawg nodes visited, compute_move rejection reasons
+(both from wsbot.STATS) and peak memory for generate, compute_move,
+best_move, generate_batch and load_dawg. Every case runs in a forked
+process so memory figures do not leak between cases.
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+    python benchmark.py --processes 4 --compare baseline.json
+
+Without a path, --compare reads files/baseline.json, a full serial run
+saved on a single-core host; save your own before drawing conclusions.
+
+--check instead compares the targeted searches, best_move and
+generate_batch with a full generation on every fixture, and fails on any
+difference.
+'''
+
+import Queue
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+import traceback
+
+import wsbot
+
+FIXTURES = 'files/benchmark.json'
+BASELINE = 'files/baseline.json'
+ENGINES = ['dawg', 'gaddag']
+SEED = 2012
+MAX_FILLED = wsbot.BOARD_SIZE - (wsbot.BOARD_SIZE / 2)
+
+
+def get_rss():
+    '''
+    Current resident set size in KB.
+    '''
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_board(fixture):
+    board = wsbot.Board(fixture['left'], fixture['top'])
+    board.tiles = list(str(''.join(fixture['rows'])))
+    return board
+
+
+def dump_board(name, board):
+    rows = str(board).split('\n')
+    return {'name': name, 'left': board.left, 'top': board.top,
+        'rows': rows}
+
+
+def run_generate(board, rack, engine, processes=1):
+    wsbot.STATS = wsbot.Stats()
+    start = time.time()
+    moves = wsbot.generate_moves(board, rack, engine, processes)
+    seconds = time.time() - start
+    result = {'seconds': seconds, 'moves': len(moves),
+        'moves_per_sec': len(moves) / seconds if seconds else 0}
+    # nodes of pool workers are counted in their own processes
+    if processes == 1:
+        result['nodes'] = wsbot.STATS.counters['nodes']
+    return result
+
+
+def run_compute_move(board, rack):
+    calls = []
+    compute_move = wsbot.compute_move
+
+    def recorder(*args):
+        calls.append(args)
+        return compute_move(*args)
+    wsbot.compute_move = recorder
+    wsbot.generate_moves(board, rack, 'dawg', 1)
+    wsbot.compute_move = compute_move
+    # count rejections on a separate pass, keeping the timed one clean
+    wsbot.STATS = wsbot.Stats()
+    for args in calls:
+        compute_move(*args)
+    rejected = dict((name[len('rejected_'):], value)
+        for name, value in wsbot.STATS.counters.iteritems()
+        if name.startswith('rejected_'))
+    wsbot.STATS = None
+    start = time.time()
+    accepted = 0
+    for args in calls:
+        if compute_move(*args):
+            accepted += 1
+    seconds = time.time() - start
+    return {'seconds': seconds, 'calls': len(calls), 'moves': accepted,
+        'calls_per_sec': len(calls) / seconds if seconds else 0,
+        'rejected': rejected}
+
+
+def run_best_move(board, rack):
+    wsbot.STATS = wsbot.Stats()
+    start = time.time()
+    move = wsbot.best_move(board, rack)
+    seconds = time.time() - start
+    return {'seconds': seconds, 'moves': int(move is not None),
+        'nodes': wsbot.STATS.counters['nodes']}
+
+
+def run_generate_racks(board, racks, batched):
+    dawg = wsbot.get_dawg()
+    start = time.time()
+    if batched:
+        results = wsbot.generate_batch(board, dawg, racks)
+    else:
+        results = [wsbot.generate(board, dawg, rack) for rack in racks]
+    seconds = time.time() - start
+    return {'seconds': seconds,
+        'moves': sum(len(moves) for moves in results)}
+
+
+def run_load(function):
+    start = time.time()
+    dawg = getattr(wsbot, function)('files/twl.dawg')
+    seconds = time.time() - start
+    # touch the whole lexicon, as a full generation eventually does
+    words = sum(1 for word in wsbot.iter_words(dawg))
+    return {'seconds': seconds, 'words': words}
+
+
+def isolated(queue, function, args):
+    rss = get_rss()
+    try:
+        result = function(*args)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_kb'] = peak
+    result['rss_growth_kb'] = max(0, peak - rss)
+    queue.put(result)
+
+
+def run_case(function, *args):
+    '''
+    Run a case in a forked process and return its figures.
+
+    Raises RuntimeError if the case fails or its process dies.
+    '''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=isolated, args=(queue, function, args))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError('%s died with exit code %s.' % (
+                    function.__name__, process.exitcode))
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('%s failed:\n%s' % (
+            function.__name__, result['error']))
+    return result
+
+
+def run(fixtures, engines, quick, processes):
+    results = {}
+    for function in ('load_dawg', 'map_dawg'):
+        results['%s/twl' % function] = run_case(run_load, function)
+    for fixture in fixtures['boards']:
+        board = make_board(fixture)
+        racks = [rack for rack in map(str, fixtures['racks'])
+            if not quick or rack.count(wsbot.WILD) <= 1]
+        for rack in racks:
+            for engine in engines:
+                name = 'generate/%s/%s/%s' % (fixture['name'], rack, engine)
+                results[name] = run_case(
+                    run_generate, board, rack, engine, processes)
+                log(name, results[name])
+            name = 'compute_move/%s/%s' % (fixture['name'], rack)
+            results[name] = run_case(run_compute_move, board, rack)
+            log(name, results[name])
+            name = 'best_move/%s/%s' % (fixture['name'], rack)
+            results[name] = run_case(run_best_move, board, rack)
+            log(name, results[name])
+        for name, batched in (('generate_racks', False),
+                ('generate_batch', True)):
+            name = '%s/%s' % (name, fixture['name'])
+            results[name] = run_case(
+                run_generate_racks, board, racks, batched)
+            log(name, results[name])
+    return results
+
+
+def move_keys(moves):
+    return set((move.x, move.y, move.direction, move.tiles, move.score)
+        for move in moves)
+
+
+def placed(move):
+    return len(move.tiles) - move.tiles.count(wsbot.SKIP)
+
+
+def check(fixtures, quick):
+    '''
+    Check the targeted searches, best_move and generate_batch against
+    a full generation, return the number of mismatches.
+    '''
+    # no fixture board can form a long word, so add one that can: a word
+    # of LONG_WORD - 1 letters across and one down, both taking an s hook
+    board = wsbot.Board()
+    for offset, letter in enumerate('abortifacient'):
+        board.tiles[board.index(1 + offset, 20)] = letter
+        board.tiles[board.index(10, 2 + offset)] = letter
+    dawg = wsbot.get_dawg()
+    failures = 0
+
+    def verdict(name, want, got):
+        sys.stderr.write('%-40s %6d %6d %s\n' % (
+            name, len(want), len(got), 'ok' if want == got else 'FAIL'))
+        return want != got
+    for fixture in fixtures['boards'] + [dump_board('hooks', board)]:
+        board = make_board(fixture)
+        racks = [rack for rack in map(str, fixtures['racks'])
+            if not quick or rack.count(wsbot.WILD) <= 1]
+        for rack in racks:
+            moves = wsbot.generate_moves(board, rack, 'dawg', 1)
+            random.seed(SEED)
+            words = sorted(set(word for move in moves for word in move.words))
+            pack = random.sample(words, min(20, len(words)))
+            cases = [
+                ('word_packs', lambda move: any(word in pack
+                        for word in move.words),
+                    lambda: wsbot.iter_target_moves(board, rack, pack)),
+                ('long_words', lambda move: any(
+                        len(word) >= wsbot.LONG_WORD for word in move.words),
+                    lambda: wsbot.iter_target_moves(board, rack,
+                        long_words=True)),
+                # whole-rack plays through one board tile at most
+                ('bingo', lambda move: placed(move) == wsbot.RACK_SIZE and
+                        len(move.words[0]) <= wsbot.ANAGRAM_WIDTH,
+                    lambda: wsbot.iter_bingo_moves(board, rack))]
+            for name, keep, search in cases:
+                failures += verdict(
+                    'check/%s/%s/%s' % (fixture['name'], rack, name),
+                    move_keys(move for move in moves if keep(move)),
+                    move_keys(search()))
+            best = wsbot.best_move(board, rack)
+            failures += verdict(
+                'check/%s/%s/best_move' % (fixture['name'], rack),
+                move_keys(wsbot.top_moves(
+                    wsbot.generate_iter(board, dawg, rack), 1)),
+                move_keys([best] if best else []))
+        # a repeated rack and a short one, as when comparing swaps
+        batch = racks + [racks[0], racks[0][:3]]
+        for number, (rack, got) in enumerate(
+                zip(batch, wsbot.generate_batch(board, dawg, batch))):
+            failures += verdict(
+                'check/%s/%d:%s/batch' % (fixture['name'], number, rack),
+                move_keys(wsbot.generate(board, dawg, rack)),
+                move_keys(got))
+    return failures
+
+
+def log(name, result):
+    sys.stderr.write('%-48s %8.3fs %8d moves %10s nodes %8d KB\n' % (
+        name, result['seconds'], result.get('moves', 0),
+        result.get('nodes', '-'), result['rss_growth_kb']))
+
+
+def compare(results, baseline):
+    print '%-48s %10s %10s %8s' % ('case', 'baseline', 'current', 'speedup')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        after = results[name]['seconds']
+        print '%-48s %9.3fs %9.3fs %7.2fx' % (
+            name, before, after, before / after if after else 0)
+
+
+def build_fixtures(path):
+    '''
+    Rebuild the fixture corpus by letting the engine play.
+
+    The shipped file is the reference corpus; rebuilding it changes the
+    baseline of every saved run.
+    '''
+    random.seed(SEED)
+    bag = ''.join(letter * count
+        for letter, count in sorted(wsbot.TILE_FREQUENCY.items()))
+
+    def seed_board():
+        board = wsbot.Board()
+        x = wsbot.MEDIAN_WIDTH - 2
+        for offset, letter in enumerate('quiet'):
+            board.tiles[board.index(x + offset, wsbot.MEDIAN_HEIGHT)] = letter
+        return board
+
+    def play(board, turns, key):
+        for turn in xrange(turns):
+            rack = ''.join(random.sample(bag, wsbot.RACK_SIZE))
+            moves = wsbot.generate_moves(board, rack, 'dawg', 1)
+            if moves:
+                moves.sort(key=key)
+                board.do_move(random.choice(moves[:5]))
+
+    boards = [dump_board('empty', wsbot.Board())]
+    board = seed_board()
+    play(board, 8, lambda move: move.key)
+    boards.append(dump_board('sparse', board))
+    board = seed_board()
+    placed = lambda move: (-len(move.tiles.replace(wsbot.SKIP, '')),
+        move.key)
+    while wsbot.BOARD_SIZE - board.count_empty() < MAX_FILLED - 30:
+        play(board, 1, placed)
+    boards.append(dump_board('crowded', board))
+    board = wsbot.Board()
+    words = [word for word in wsbot.iter_words(wsbot.get_dawg())
+        if len(word) >= wsbot.LONG_WORD]
+    for y in (5, 15, 25):
+        word = random.choice(words)
+        for offset, letter in enumerate(word):
+            board.tiles[board.index(2 + offset, y)] = letter
+    play(board, 12, placed)
+    boards.append(dump_board('long_words', board))
+    fixtures = {
+        'boards': boards,
+        'racks': ['aeinrst', 'cdeilmo', 'jkqvwxz', 'aeirs?t', 'ab?de?s']}
+    with open(path, 'w') as fp:
+        json.dump(fixtures, fp, indent=1, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--fixtures', default=FIXTURES)
+    parser.add_argument('--engine', action='append', choices=ENGINES,
+        help='engine to run, repeatable (default: all)')
+    parser.add_argument('--processes', type=int, default=1,
+        help='worker processes for the generate cases (default: 1)')
+    parser.add_argument('--quick', action='store_true',
+        help='skip racks with more than one blank')
+    parser.add_argument('--save', metavar='PATH',
+        help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', nargs='?',
+        const=BASELINE,
+        help='compare against a saved JSON baseline (default: %s)' % BASELINE)
+    parser.add_argument('--check', action='store_true',
+        help='check the targeted searches against a full generation')
+    parser.add_argument('--build-fixtures', action='store_true',
+        help='regenerate the fixture file and exit')
+    args = parser.parse_args()
+    if args.build_fixtures:
+        build_fixtures(args.fixtures)
+        return
+    with open(args.fixtures) as fp:
+        fixtures = json.load(fp)
+    if args.check:
+        sys.exit(1 if check(fixtures, args.quick) else 0)
+    engines = args.engine or ENGINES
+    if 'gaddag' in engines:
+        # map the gaddag once, outside of the timed cases
+        wsbot.get_gaddag()
+    results = run(fixtures, engines, args.quick, args.processes)
+    report = {
+        'python': sys.version.split()[0],
+        'processes': args.processes,
+        'engine_default': wsbot.ENGINE,
+        'numpy': wsbot.numpy is not None,
+        'cases': results}
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp)['cases'])
+
+
+if __name__ == '__main__':
+    main()
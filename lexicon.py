@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Lexicon compiler.
+
+Builds minimised dawg (and optionally gaddag and anagram index) files
+from word lists, in the versioned format: a header with the kind, record
+count and a CRC-32, then the packed records the bot maps in place.
+Sources are plain word lists, one word per line, or existing dawg files
+of either format, so TWL, SOWPODS and custom lists can be merged:
+
+    python lexicon.py build files/twl.dawg packs.txt -o files/custom.dawg \\
+        --gaddag files/custom.gaddag --anagrams files/custom.anagram
+    python lexicon.py index files/twl.dawg
+    python lexicon.py dump files/sowpods.dawg > sowpods.txt
+    python lexicon.py info files/twl.dawg
+'''
+
+import argparse
+import os
+import re
+import sys
+
+import wsbot
+
+WORD = re.compile('^[a-z]+$')
+KINDS = {None: 'legacy', wsbot.LEXICON_DAWG: 'dawg',
+    wsbot.LEXICON_GADDAG: 'gaddag', wsbot.LEXICON_ANAGRAM: 'anagram'}
+
+
+def read_words(path):
+    '''
+    Enumerate the words of a word list or dawg file.
+    '''
+    with open(path, 'rb') as fp:
+        head = fp.read(len(wsbot.LEXICON_MAGIC))
+    if path.endswith('.dawg') or head == wsbot.LEXICON_MAGIC:
+        dawg = wsbot.Dawg(path)
+        if dawg.kind == wsbot.LEXICON_GADDAG:
+            raise ValueError('Not a dawg: %s.' % path)
+        for word in wsbot.iter_words(dawg.root):
+            yield word
+        dawg.close()
+        return
+    with open(path) as fp:
+        for line in fp:
+            word = line.strip().lower()
+            if WORD.match(word):
+                yield word
+
+
+def build(args):
+    words = set()
+    for path in args.sources:
+        count = len(words)
+        words.update(read_words(path))
+        log('%s: %d new words' % (path, len(words) - count))
+    words = sorted(words)
+    wsbot.build_dawg(words, args.output)
+    log('%s: %d words, %d bytes' % (
+        args.output, len(words), os.path.getsize(args.output)))
+    if args.gaddag:
+        wsbot.build_gaddag(words, args.gaddag)
+        log('%s: %d bytes' % (args.gaddag, os.path.getsize(args.gaddag)))
+    if args.anagrams:
+        wsbot.build_anagrams(words, args.anagrams)
+        log('%s: %d bytes' % (args.anagrams,
+            os.path.getsize(args.anagrams)))
+
+
+def index(args):
+    words = list(read_words(args.path))
+    for build, path in (
+            (wsbot.build_gaddag, wsbot.gaddag_path(args.path)),
+            (wsbot.build_anagrams, wsbot.anagrams_path(args.path))):
+        build(words, path)
+        log('%s: %d bytes' % (path, os.path.getsize(path)))
+
+
+def dump(args):
+    for word in read_words(args.path):
+        print word
+
+
+def info(args):
+    with open(args.path, 'rb') as fp:
+        offset, size, kind = wsbot.lexicon_layout(fp.read(), args.path)
+    print '%s: %s, %d %s%s' % (args.path, KINDS[kind], size,
+        'words' if kind == wsbot.LEXICON_ANAGRAM else 'edges',
+        ', checksum ok' if kind else '')
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers()
+    command = commands.add_parser('build',
+        help='compile word lists and dawg files into one dawg')
+    command.add_argument('sources', nargs='+')
+    command.add_argument('-o', '--output', required=True)
+    command.add_argument('--gaddag', metavar='PATH',
+        help='also write the gaddag of the same words')
+    command.add_argument('--anagrams', metavar='PATH',
+        help='also write the anagram index of the same words')
+    command.set_defaults(function=build)
+    command = commands.add_parser('index',
+        help='write the gaddag and anagram index the bot maps next to '
+        'a dawg')
+    command.add_argument('path')
+    command.set_defaults(function=index)
+    command = commands.add_parser('dump', help='print the words of a dawg')
+    command.add_argument('path')
+    command.set_defaults(function=dump)
+    command = commands.add_parser('info',
+        help='show the format of a lexicon file and check it')
+    command.add_argument('path')
+    command.set_defaults(function=info)
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Local stand-in for the Wordsquared server.
+
+Implements the endpoints WordsquaredPlayer talks to on a persistent,
+unbounded board. Plays are checked and scored with the bot's own
+compute_move against the DAWG, racks are dealt from TILE_FREQUENCY and
+every successful play is appended to a journal that is replayed on start.
+
+    python server.py --port 8000
+    WSQD=http://localhost:8000 python wsbot.py
+
+With --bots the server starts that many wsbot.py processes against itself
+and prints turns/sec and requests per turn every --interval seconds:
+
+    python server.py --bots 8 --duration 60
+'''
+
+import argparse
+import BaseHTTPServer
+import Cookie
+import SocketServer
+import cgi
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+
+import wsbot
+
+JOURNAL = 'files/world.jsonl'
+SEED_WORD = 'wordsquared'
+CSRF_TOKEN = 'stand-in-csrf-token'
+SESSION_COOKIE = '_wordsquared_session'
+
+
+class Player(object):
+    '''
+    Account state: rack and last successful play.
+    '''
+
+    def __init__(self, game_id, username, gx, gy):
+        self.game_id = game_id
+        self.username = username
+        self.gx = gx
+        self.gy = gy
+        self.rack = []
+        self.shortlink = None
+        self.score = 0
+
+
+class World(object):
+    '''
+    Unbounded board keyed by world coordinates, plus the players on it.
+    '''
+
+    def __init__(self, dawg, journal=None):
+        self.dawg = dawg
+        self.journal = journal
+        self.tiles = {}
+        self.players = {}
+        self.bag = ''.join(letter * count
+            for letter, count in sorted(wsbot.TILE_FREQUENCY.items()))
+        self.lock = threading.Lock()
+        self.journal_lock = threading.Lock()
+        self.requests = {}
+        self.connections = 0
+        self.plays = 0
+        self.rejected = 0
+        self.started = time.time()
+        if journal and os.path.exists(journal):
+            with open(journal) as fp:
+                for line in fp:
+                    for x, y, letter in json.loads(line):
+                        self.tiles[(x, y)] = str(letter)
+        if not self.tiles:
+            tiles = [(x - len(SEED_WORD) / 2, 0, letter)
+                for x, letter in enumerate(SEED_WORD)]
+            self.place(tiles)
+            self.record(tiles)
+
+    def place(self, tiles):
+        for x, y, letter in tiles:
+            self.tiles[(x, y)] = letter
+
+    def record(self, tiles):
+        '''
+        Append placed tiles to the journal, outside of the world lock.
+        '''
+        if self.journal:
+            with self.journal_lock:
+                with open(self.journal, 'a') as fp:
+                    fp.write(json.dumps(tiles) + '\n')
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+
+    def deal(self, player, count=wsbot.RACK_SIZE):
+        while len(player.rack) < count:
+            player.rack.append(random.choice(self.bag).upper())
+
+    def sign_in(self, username):
+        with self.lock:
+            game_id = str(len(self.players) + 1)
+            x, y = random.choice(self.tiles.keys())
+            player = self.players[game_id] = Player(game_id, username, x, y)
+            player.shortlink = new_shortlink()
+            self.deal(player)
+        return player
+
+    def tiles_for(self, left, right, top, bottom):
+        '''
+        Tiles of a world rectangle, read square by square unless the
+        world holds fewer tiles than the rectangle has squares.
+        '''
+        with self.lock:
+            if (right - left + 1) * (top - bottom + 1) > len(self.tiles):
+                found = [(x, y, letter)
+                    for (x, y), letter in self.tiles.iteritems()
+                    if left <= x <= right and bottom <= y <= top]
+            else:
+                get = self.tiles.get
+                found = [(x, y, get((x, y)))
+                    for y in xrange(bottom, top + 1)
+                    for x in xrange(left, right + 1)]
+                found = [tile for tile in found if tile[2] is not None]
+        return [{'x': x, 'y': y, 'letter': letter.upper()}
+            for x, y, letter in found]
+
+    def swap(self, player):
+        with self.lock:
+            player.rack = []
+            self.deal(player)
+
+    def play(self, player, placed):
+        '''
+        Check and score a play, returning (score, message).
+        '''
+        with self.lock:
+            score, message = self._play(player, placed)
+            if score is None:
+                self.rejected += 1
+                return score, message
+            self.plays += 1
+            tiles = [(x, y, self.tiles[(x, y)]) for x, y, letter in placed]
+        self.record(sorted(tiles))
+        return score, message
+
+    def _play(self, player, placed):
+        if not placed:
+            return None, 'You must place at least one tile'
+        for x, y, letter in placed:
+            if (x, y) in self.tiles:
+                return None, \
+                    'You tried to place a tile where one already exists'
+        xs = set(x for x, y, letter in placed)
+        ys = set(y for x, y, letter in placed)
+        if len(ys) == 1:
+            direction = wsbot.HORIZONTAL
+        elif len(xs) == 1:
+            direction = wsbot.VERTICAL
+        else:
+            return None, 'Your tiles must be in a single row or column'
+        # take the letters from the rack, lower case unless a blank
+        rack = list(player.rack)
+        letters = {}
+        for x, y, letter in placed:
+            if letter in rack:
+                rack.remove(letter)
+                letters[(x, y)] = letter.lower()
+            elif wsbot.WILD in rack:
+                rack.remove(wsbot.WILD)
+                letters[(x, y)] = letter.upper()
+            else:
+                return None, '%s is not in your rack' % letter
+        # world y grows upwards, board y downwards
+        dx, dy = wsbot.DIRECTION[direction]
+        dy = -dy
+        cells = sorted(letters, key=lambda (x, y): (x, -y))
+        x, y = cells[0]
+        while (x - dx, y - dy) in self.tiles:
+            x, y = x - dx, y - dy
+        start = (x, y)
+        tiles = []
+        while (x, y) in letters or (x, y) in self.tiles:
+            if (x, y) in letters:
+                tiles.append(letters[(x, y)])
+            else:
+                tiles.append(wsbot.SKIP)
+            x, y = x + dx, y + dy
+        if len(tiles) - tiles.count(wsbot.SKIP) != len(letters):
+            return None, 'Your tiles must not leave gaps'
+        if not any((x + ax, y + ay) in self.tiles
+                for x, y in letters
+                for ax, ay in ((1, 0), (-1, 0), (0, 1), (0, -1))):
+            return None, \
+                'You must play your tiles next to at least one existing tile'
+        # score on a window centred on the start of the play
+        left = start[0] - wsbot.MEDIAN_WIDTH / 2
+        top = start[1] + wsbot.MEDIAN_HEIGHT
+        if direction == wsbot.VERTICAL:
+            left = start[0] - wsbot.MEDIAN_WIDTH
+            top = start[1] + wsbot.MEDIAN_HEIGHT / 2
+        board = wsbot.Board(left, top)
+        get = self.tiles.get
+        for by in xrange(board.height):
+            for bx in xrange(board.width):
+                letter = get((left + bx, top - by))
+                if letter is not None:
+                    board.tiles[board.index(bx, by)] = letter
+        move = wsbot.compute_move(board, self.dawg,
+            start[0] - left, top - start[1], direction, ''.join(tiles))
+        if move is None:
+            for word in self.words(letters, dx, dy):
+                if not wsbot.check_dawg(self.dawg, word):
+                    return None, '%s is not a valid word' % word.upper()
+            return None, 'Your play is not valid'
+        self.place([(x, y, letter)
+            for (x, y), letter in sorted(letters.iteritems())])
+        player.rack = rack
+        player.gx, player.gy = start
+        player.score += move.score
+        player.shortlink = new_shortlink()
+        self.deal(player)
+        return move.score, None
+
+    def words(self, letters, dx, dy):
+        '''
+        Main word then cross words formed by letters, for error messages.
+        '''
+        words = []
+        for (x, y), ax, ay in [(min(letters), dx, dy)] + \
+                [(cell, -dy, -dx) for cell in sorted(letters)]:
+            while (x - ax, y - ay) in letters or (x - ax, y - ay) in self.tiles:
+                x, y = x - ax, y - ay
+            word = []
+            while (x, y) in letters or (x, y) in self.tiles:
+                word.append(letters.get((x, y)) or self.tiles[(x, y)])
+                x, y = x + ax, y + ay
+            if len(word) > 1:
+                words.append(''.join(word).lower())
+        return words
+
+    def stats(self):
+        with self.lock:
+            seconds = time.time() - self.started
+            requests = sum(self.requests.values())
+            return {
+                'seconds': round(seconds, 1),
+                'players': len(self.players),
+                'tiles': len(self.tiles),
+                'plays': self.plays,
+                'rejected': self.rejected,
+                'turns_per_sec': round(self.plays / seconds, 2),
+                'requests': dict(self.requests),
+                'connections': self.connections,
+                'requests_per_turn': round(
+                    float(requests) / self.plays, 2) if self.plays else None}
+
+
+def new_shortlink():
+    return '%08x' % random.getrandbits(32)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Route requests to the World.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.world.connect()
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.params = dict(urlparse.parse_qsl(url.query))
+        self.route(url.path)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.params = dict(cgi.parse_qsl(body, keep_blank_values=True))
+        self.route(urlparse.urlparse(self.path).path)
+
+    def route(self, path):
+        world = self.server.world
+        world.count(path)
+        routes = {
+            '/': self.index,
+            '/users/sign_in': self.sign_in,
+            '/v2/load_game': self.load_game,
+            '/v2/tiles_for': self.tiles_for,
+            '/v2/drag': self.drag,
+            '/v2/play': self.play,
+            '/v2/swap_rack': self.swap_rack,
+            '/stats': self.stats}
+        if path not in routes:
+            return self.reply({'result': 'failure', 'message': 'Not found'},
+                status=404)
+        try:
+            routes[path]()
+        except (KeyError, ValueError), e:
+            self.reply({'result': 'failure', 'message': repr(e)}, status=400)
+
+    def reply(self, data, status=200, content_type='application/json'):
+        if content_type == 'application/json':
+            data = json.dumps(data)
+        cookie = Cookie.SimpleCookie()
+        cookie[SESSION_COOKIE] = self.session()
+        cookie[SESSION_COOKIE]['path'] = '/'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Set-Cookie', cookie[SESSION_COOKIE].OutputString())
+        self.end_headers()
+        self.wfile.write(data)
+
+    def session(self):
+        cookie = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        if SESSION_COOKIE in cookie:
+            return cookie[SESSION_COOKIE].value
+        return new_shortlink()
+
+    def player(self):
+        return self.server.world.players[self.params['game']]
+
+    def index(self):
+        self.reply('<html><head><meta name="csrf-token" content="%s"/>'
+            '</head></html>' % CSRF_TOKEN, content_type='text/html')
+
+    def sign_in(self):
+        player = self.server.world.sign_in(self.params['user[username]'])
+        self.reply({'gameId': player.game_id})
+
+    def load_game(self):
+        player = self.player()
+        self.reply({
+            'shortlink': player.shortlink,
+            'assigned_letters': player.rack,
+            'user': {'profile': {
+                'recent_words': [{'coords': [{'x': player.gx,
+                    'y': player.gy}]}],
+                'word_packs': {'not_owned': [], 'user_word_packs': {}}}}})
+
+    def tiles_for(self):
+        params = dict((name, int(self.params[name]))
+            for name in ('left', 'right', 'top', 'bottom'))
+        self.reply({'result': 'success',
+            'tiles': self.server.world.tiles_for(**params)})
+
+    def drag(self):
+        self.reply({'result': 'success'})
+
+    def play(self):
+        player = self.player()
+        placed = []
+        seq = 0
+        while 'tiles[%d][letter]' % seq in self.params:
+            placed.append((
+                int(self.params['tiles[%d][x]' % seq]),
+                int(self.params['tiles[%d][y]' % seq]),
+                self.params['tiles[%d][letter]' % seq].upper()))
+            seq += 1
+        score, message = self.server.world.play(player, placed)
+        if score is None:
+            return self.reply({'result': 'failure', 'message': message})
+        self.reply({
+            'result': 'success',
+            'shortlink': player.shortlink,
+            'move_score': score,
+            'assigned_letters': player.rack})
+
+    def swap_rack(self):
+        player = self.player()
+        self.server.world.swap(player)
+        self.reply({'result': 'success', 'assigned_letters': player.rack})
+
+    def stats(self):
+        self.reply(self.server.world.stats())
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, world, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.world = world
+        self.verbose = verbose
+
+
+def run_bots(server, count, duration, interval):
+    '''
+    Play count wsbot.py processes against the server and report.
+    '''
+    env = dict(os.environ)
+    env['WSQD'] = 'http://%s:%d' % server.server_address
+    bots = [subprocess.Popen([sys.executable, 'wsbot.py'], env=env,
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        for i in xrange(count)]
+    started = time.time()
+    try:
+        while not duration or time.time() - started < duration:
+            time.sleep(interval)
+            print json.dumps(server.world.stats(), sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        for bot in bots:
+            bot.terminate()
+            bot.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--journal', default=JOURNAL,
+        help='file the board is kept in, empty to keep it in memory')
+    parser.add_argument('--bots', type=int, default=0,
+        help='wsbot.py processes to play against the server')
+    parser.add_argument('--duration', type=int, default=0,
+        help='seconds to run the bots for (default: until interrupted)')
+    parser.add_argument('--interval', type=int, default=10,
+        help='seconds between stats lines with --bots')
+    parser.add_argument('--lexicon', default=wsbot.LEXICON,
+        help='dawg plays are checked against')
+    parser.add_argument('--verbose', action='store_true',
+        help='log every request')
+    args = parser.parse_args()
+    world = World(wsbot.get_dawg(args.lexicon), args.journal or None)
+    server = Server((args.host, args.port), world, args.verbose)
+    if not args.bots:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        run_bots(server, args.bots, args.duration, args.interval)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,39 @@
 # -*- coding: utf-8 -*-
 
 import requests
+import requests.adapters
 import re
+import urlparse
 import json
 import sys
 import random
 import collections
-import operator
+import bisect
+import itertools
 import struct
+import mmap
+import os
+import array
+import multiprocessing
+import multiprocessing.pool
 import logging
+import threading
 import time
 import traceback
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Must be an odd number
 ODD_NUMBER = 31
 
 USERNAME = 'username'
 PASSWORD = 'password'
+# (username, password) of every account played by this process
+ACCOUNTS = [(USERNAME, PASSWORD)]
 
 # 1: Display standard debugging message
 # 2: Display verbose message from 'requests'
@@ -26,27 +43,68 @@ DEBUG_LEVEL = 1
 DEBUG = True
 # Timeout for requests()
 TIMEOUT = 30
+# Keep-alive connection pools and connections kept per pool
+POOL_CONNECTIONS = 1
+POOL_MAXSIZE = 8
+# Threads fetching the regions around a location_shift at once
+FETCH_THREADS = 8
+# Requests in flight at once over all the accounts of the process
+MAX_IN_FLIGHT = 8
+# Squares around the window searched when it has no move, 0 to move on
+AREA_MARGIN = 16
+# Side of the cached world chunks, seconds before one is fetched again
+# and seconds before one is dropped, whether used or not
+CHUNK_SIZE = 16
+CHUNK_TTL = 30
+CHUNK_MAX_AGE = 300
+# Collect engine and network counters, logged once per turn
+INSTRUMENT = False
+# Move generator: 'dawg' or 'gaddag'. On files/benchmark.json the gaddag
+# visits 5-40% fewer nodes than the dawg (far from a several-fold cut) for
+# about 1.5x the memory; build it first with `lexicon.py index`
+ENGINE = 'dawg'
+# Default lexicon, e.g. 'files/sowpods.dawg'; its gaddag sits next to it
+LEXICON = 'files/twl.dawg'
+# Worker processes for move generation, 1 to generate in-process
+PROCESSES = 1
+# Candidates kept per category for each turn
+TOP_MOVES = 100
+# Turn candidates memoised by board and rack, 0 to disable
+MOVE_CACHE_SIZE = 16
+# Log of the bot, besides the console
+LOG_FILE = 'logs/wordsquared.log'
 
 
 # Utils
-formatter = logging.Formatter('%(asctime)-6s: %(name)s - '
-                              '%(levelname)s - %(message)s')
-
-consoleLogger = logging.StreamHandler()
-consoleLogger.setFormatter(formatter)
-logging.getLogger('').addHandler(consoleLogger)
-
-fileLogger = logging.FileHandler(filename='logs/wordsquared.log')
-fileLogger.setLevel(logging.INFO)
-fileLogger.setFormatter(formatter)
-logging.getLogger('').addHandler(fileLogger)
-
 logger = logging.getLogger('wordsquared-bot')
 logger.setLevel(logging.INFO)
 if DEBUG:
     logger.setLevel(logging.DEBUG)
 
 
+def setup_logging(path=LOG_FILE):
+    '''
+    Log to the console and to path, creating its directory.
+
+    Only the bot sets this up; tools importing the module log nowhere
+    unless they do.
+    '''
+    formatter = logging.Formatter('%(asctime)-6s: %(name)s - '
+                                  '%(levelname)s - %(message)s')
+
+    consoleLogger = logging.StreamHandler()
+    consoleLogger.setFormatter(formatter)
+    logging.getLogger('').addHandler(consoleLogger)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fileLogger = logging.FileHandler(filename=path)
+    fileLogger.setLevel(logging.INFO)
+    fileLogger.setFormatter(formatter)
+    logging.getLogger('').addHandler(fileLogger)
+
+
 def check_even(number):
     if number % 2 == 0:
         return True
@@ -64,6 +122,89 @@ def get_median(numeric_list):
         return float((lower + upper)) / 2
 
 
+class Stats(object):
+    '''
+    Counters and timers for the engine and the bot loop.
+
+    Hooks check the module-level STATS first, so with instrumentation
+    off they cost one global lookup.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.defaultdict(int)
+        self.timers = collections.defaultdict(float)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def merge(self, other):
+        for name, value in other.counters.iteritems():
+            self.counters[name] += value
+        for name, seconds in other.timers.iteritems():
+            self.timers[name] += seconds
+
+    def record(self):
+        '''
+        Compact snapshot: counters as they are, timers in milliseconds.
+        '''
+        record = dict(self.counters)
+        for name, seconds in self.timers.iteritems():
+            record['%s_ms' % name] = round(seconds * 1000, 1)
+        return record
+
+
+class ThreadStats(threading.local, Stats):
+    '''
+    Stats of the calling thread. Every account plays on a thread of its
+    own, so each game logs and resets only its own turns.
+    '''
+
+
+class Timer(object):
+    '''
+    Time a block into STATS.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if STATS is not None:
+            STATS.add_time(self.name, time.time() - self.start)
+
+
+def timed(name):
+    '''
+    Context manager timing a block, a no-op with instrumentation off.
+    '''
+    if STATS is None:
+        return NOT_TIMED
+    return Timer(name)
+
+
+class NotTimed(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOT_TIMED = NotTimed()
+STATS = ThreadStats() if INSTRUMENT else None
+IN_FLIGHT = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
 # Variables
 if DEBUG and DEBUG_LEVEL >= 2:
         REQUESTS_CONFIG = {'verbose': sys.stderr}
@@ -74,7 +215,8 @@ USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_3)' \
              ' AppleWebKit/536.6 (KHTML, like Gecko)' \
              ' Chrome/20.0.1096.1 Safari/536.6'
 
-WSQD = 'http://wordsquared.com'
+# Base URL of the game, WSQD=http://localhost:8000 for server.py
+WSQD = os.environ.get('WSQD', 'http://wordsquared.com')
 
 WIDTH = ODD_NUMBER
 HEIGHT = ODD_NUMBER
@@ -99,11 +241,39 @@ LOCATION_START = {
     'NW': (WIDTH * HEIGHT),
 }
 RACK_SIZE = 7
+LONG_WORD = 14
 BINGO = 0
 EMPTY = '.'
 WILD = '?'
 SKIP = '-'
 SENTINEL = '$'
+SEPARATOR = '>'
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+LETTER_BITS = dict((letter, 1 << i) for i, letter in enumerate(ALPHABET))
+ALL_LETTERS = (1 << 26) - 1
+# Edge labels in the order the edges of a node are packed, one bit each
+# in the label sets of the dawg nodes
+EDGE_LABELS = SENTINEL + SEPARATOR + ALPHABET
+EDGE_BITS = dict((label, 1 << i) for i, label in enumerate(EDGE_LABELS))
+EDGE = struct.Struct('<I')
+# Set bits of every 14-bit number, for the positions of the edges
+POPCOUNT = bytearray(bin(i).count('1') for i in xrange(1 << 14))
+# Dawg depths not computed yet, in their array of bytes
+UNKNOWN_DEPTH = 0xff
+# Versioned lexicon files: magic, version, kind, edge count and CRC-32 of
+# the edges, followed by the same edge array as the legacy files
+LEXICON_MAGIC = 'WSQD'
+LEXICON_VERSION = 1
+LEXICON_HEADER = struct.Struct('<4sHHII')
+LEXICON_DAWG = 1
+LEXICON_GADDAG = 2
+LEXICON_ANAGRAM = 3
+# Anagram files hold records of a signature (the sorted letters) and a
+# word of RACK_SIZE or RACK_SIZE + 1 letters, both padded with NUL, sorted
+ANAGRAM_WIDTH = RACK_SIZE + 1
+LEXICON_WIDTH = {LEXICON_ANAGRAM: ANAGRAM_WIDTH * 2}
+# Rack slot of the blank tile, after the 26 letters
+BLANK = 26
 LETTER_MULTIPLIER = [
     1, 1, 2, 1, 1, 1, 2, 1, 2, 1, 1, 1, 2, 1,
     1, 2, 1, 1, 1, 3, 1, 1, 1, 3, 1, 1, 1, 2,
@@ -178,19 +348,71 @@ class Move(object):
             return col + row
 
 
+PREMIUMS = {}
+# Random keys per square and tile, extended as larger boards show up
+ZOBRIST = []
+ZOBRIST_TILES = dict((tile, index) for index, tile in
+    enumerate(ALPHABET + ALPHABET.upper()))
+ZOBRIST_RANDOM = random.Random(2012)
+
+
+def get_premiums(left, top, width, height):
+    '''
+    Get the letter and word multipliers of a viewport, one per square.
+
+    left and top are the world coordinates of the top left square. The
+    tables only depend on where the viewport falls in the 14x14 premium
+    pattern, so they are shared between boards.
+    '''
+    key = (left % 14, top % 14, width, height)
+    if key not in PREMIUMS:
+        letter_premium = []
+        word_premium = []
+        for y in xrange(height):
+            for x in xrange(width):
+                bonus_index = ((13 - top + y) % 14) * 14 + (left + x) % 14
+                letter_premium.append(LETTER_MULTIPLIER[bonus_index])
+                word_premium.append(WORD_MULTIPLIER[bonus_index])
+        PREMIUMS[key] = (letter_premium, word_premium)
+    return PREMIUMS[key]
+
+
+def zobrist_key(index, tile):
+    '''
+    Random key of a tile on a square, 0 for an empty square.
+    '''
+    if tile == EMPTY:
+        return 0
+    while len(ZOBRIST) <= index:
+        ZOBRIST.append([ZOBRIST_RANDOM.getrandbits(64)
+            for i in xrange(len(ZOBRIST_TILES))])
+    return ZOBRIST[index][ZOBRIST_TILES[tile]]
+
+
 class Board(object):
     '''
     Handling local board.
     '''
 
-    def __init__(self):
-        self.width = WIDTH
-        self.height = HEIGHT
+    def __init__(self, left=0, top=0, width=WIDTH, height=HEIGHT):
+        self.width = width
+        self.height = height
         self.start = START
-        self.letter_multiplier = LETTER_MULTIPLIER
-        self.word_multiplier = WORD_MULTIPLIER
+        # World coordinates of the top left square
+        self.left = left
+        self.top = top
+        self.letter_premium, self.word_premium = get_premiums(
+            left, top, self.width, self.height)
         self.tile_value = TILE_VALUE
-        self.tiles = [EMPTY] * BOARD_SIZE
+        self.tiles = [EMPTY] * (width * height)
+        # Move generation tables, kept up to date by do_move/undo_move
+        self.dawg = None
+        self.distances = {}
+        self.checks = {}
+        # uint8 NumPy copy of the tiles, built on demand
+        self.grid = None
+        # Zobrist hash of the tiles, built on demand
+        self.hash = None
 
     def __str__(self):
         width = self.width
@@ -209,6 +431,44 @@ class Board(object):
     def is_empty(self, x, y):
         return self.get_tile(x, y) == EMPTY
 
+    def get_grid(self):
+        '''
+        Get the tiles as a uint8 NumPy array of rows, None without NumPy.
+        '''
+        if numpy is None:
+            return None
+        if self.grid is None:
+            self.grid = numpy.frombuffer(''.join(self.tiles),
+                dtype=numpy.uint8).reshape(self.height, self.width).copy()
+        return self.grid
+
+    def get_hash(self):
+        '''
+        Get the Zobrist hash of the tiles, kept up to date by do_move,
+        undo_move and load once built.
+        '''
+        if self.hash is None:
+            self.hash = 0
+            for index, tile in enumerate(self.tiles):
+                if tile != EMPTY:
+                    self.hash ^= zobrist_key(index, tile)
+        return self.hash
+
+    def set_tile(self, index, tile):
+        if self.hash is not None:
+            self.hash ^= zobrist_key(index, self.tiles[index]) ^ \
+                zobrist_key(index, tile)
+        self.tiles[index] = tile
+
+    def count_empty(self):
+        '''
+        Count empty squares.
+        '''
+        grid = self.get_grid()
+        if grid is None:
+            return self.tiles.count(EMPTY)
+        return int((grid == ord(EMPTY)).sum())
+
     def is_adjacent(self, x, y):
         #if self.index(x, y) == self.start:
         #   return True
@@ -222,18 +482,107 @@ class Board(object):
             return True
         return False
 
+    def starts(self, direction, tile_count):
+        '''
+        Get starting points for a move direction.
+        '''
+        with timed('starts'):
+            return self._starts(direction, tile_count)
+
+    def _starts(self, direction, tile_count):
+        distances = self.distances.get(direction)
+        if distances is None and self.get_grid() is not None:
+            distances = self.distances[direction] = _grid_distances(
+                self, direction)
+        elif distances is None:
+            distances = self.distances[direction] = \
+                [0] * (self.width * self.height)
+            dx, dy = DIRECTION[direction]
+            if direction == HORIZONTAL:
+                for y in xrange(self.height):
+                    _line_distances(self, 0, y, dx, dy, distances)
+            else:
+                for x in xrange(self.width):
+                    _line_distances(self, x, 0, dx, dy, distances)
+        return [d if d <= tile_count else 0 for d in distances]
+
+    def cross_checks(self, dawg, direction):
+        '''
+        Get cross-check table for a move direction.
+        '''
+        if self.dawg is not dawg:
+            self.dawg = dawg
+            self.checks = {}
+        checks = self.checks.get(direction)
+        if checks is None:
+            with timed('cross_checks'):
+                checks = self.checks[direction] = get_cross_checks(
+                    self, dawg, direction)
+        return checks
+
+    def refresh(self, cells):
+        '''
+        Update move generation tables around changed squares.
+
+        Starting points change on the lines through and next to a square,
+        cross-checks on the perpendicular line through it.
+        '''
+        rows = set()
+        columns = set()
+        if self.grid is not None:
+            for x, y in cells:
+                self.grid[y, x] = ord(self.get_tile(x, y))
+        for x, y in cells:
+            rows.update(row for row in (y - 1, y, y + 1)
+                if 0 <= row < self.height)
+            columns.update(column for column in (x - 1, x, x + 1)
+                if 0 <= column < self.width)
+        distances = self.distances.get(HORIZONTAL)
+        if distances is not None:
+            for y in rows:
+                _line_distances(self, 0, y, 1, 0, distances)
+        distances = self.distances.get(VERTICAL)
+        if distances is not None:
+            for x in columns:
+                _line_distances(self, x, 0, 0, 1, distances)
+        checks = self.checks.get(HORIZONTAL)
+        if checks is not None:
+            for x in set(x for x, y in cells):
+                for y in xrange(self.height):
+                    checks[self.index(x, y)] = _cross_check(
+                        self, self.dawg, x, y, 0, 1)
+        checks = self.checks.get(VERTICAL)
+        if checks is not None:
+            for y in set(y for x, y in cells):
+                for x in xrange(self.width):
+                    checks[self.index(x, y)] = _cross_check(
+                        self, self.dawg, x, y, 1, 0)
+
+    def load(self, tiles):
+        '''
+        Replace the tiles, e.g. with a reloaded board of the same area.
+        '''
+        cells = []
+        for index in xrange(len(tiles)):
+            if self.tiles[index] != tiles[index]:
+                self.set_tile(index, tiles[index])
+                cells.append((index % self.width, index / self.width))
+        self.refresh(cells)
+
     def do_move(self, move):
         '''
         Execute the move on local board.
         '''
         x, y = move.x, move.y
         dx, dy = DIRECTION[move.direction]
+        cells = []
         for tile in move.tiles:
             if tile != SKIP:
-                index = self.index(x, y)
-                self.tiles[index] = tile
+                self.set_tile(self.index(x, y), tile)
+                cells.append((x, y))
             x += dx
             y += dy
+        self.refresh(cells)
 
     def undo_move(self, move):
         '''
@@ -241,26 +590,66 @@ class Board(object):
         '''
         x, y = move.x, move.y
         dx, dy = DIRECTION[move.direction]
+        cells = []
         for tile in move.tiles:
             if tile != SKIP:
-                index = self.index(x, y)
-                self.tiles[index] = EMPTY
+                self.set_tile(self.index(x, y), EMPTY)
+                cells.append((x, y))
             x += dx
             y += dy
+        self.refresh(cells)
 
 # Engine
 
+def lexicon_layout(data, path):
+    '''
+    Get (offset, records, kind) of the record array in a lexicon file.
+
+    Versioned files are checked against their header and checksum, legacy
+    files are a bare edge array of unknown kind.
+    '''
+    if data[:len(LEXICON_MAGIC)] != LEXICON_MAGIC:
+        return 0, len(data) / 4, None
+    magic, version, kind, size, checksum = \
+        LEXICON_HEADER.unpack_from(data, 0)
+    if version != LEXICON_VERSION:
+        raise ValueError('Unsupported lexicon version %d: %s.' % (
+            version, path))
+    offset = LEXICON_HEADER.size
+    if offset + size * LEXICON_WIDTH.get(kind, 4) != len(data):
+        raise ValueError('Truncated lexicon: %s.' % path)
+    crc = 0
+    for start in xrange(offset, len(data), 1 << 20):
+        crc = zlib.crc32(data[start:start + (1 << 20)], crc)
+    if crc & 0xffffffff != checksum:
+        raise ValueError('Lexicon checksum mismatch: %s.' % path)
+    return offset, size, kind
+
+
+def write_lexicon(path, data, kind):
+    '''
+    Write packed edges, or anagram records, as a versioned lexicon file.
+    '''
+    records = data if isinstance(data, str) else data.tostring()
+    with open(path, 'wb') as fp:
+        fp.write(LEXICON_HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, kind,
+            len(records) / LEXICON_WIDTH.get(kind, 4),
+            zlib.crc32(records) & 0xffffffff))
+        fp.write(records)
+
+
 def load_dawg(path):
     '''
     Load dawg file.
     '''
     with open(path, 'rb') as fp:
         data = fp.read()
+    offset, size, kind = lexicon_layout(data, path)
     groups = {}
     start = 0
     lookup = {}
-    for index in xrange(len(data) / 4):
-        block = data[index * 4:index * 4 + 4]
+    for index in xrange(size):
+        block = data[offset + index * 4:offset + index * 4 + 4]
         x = struct.unpack('<I', block)[0]
         link = x & 0xffffff
         letter = chr((x >> 24) & 0x7f)
@@ -276,18 +665,440 @@ def load_dawg(path):
     return groups[0]
 
 
+class DawgNode(object):
+    '''
+    Dawg node read from the packed edge array.
+
+    Only the offset and the label set of the node are kept: a child is
+    found by its position among the sorted edges, counted from the labels
+    below its own. The generators skip this class and walk the offsets
+    and label sets of the Dawg directly.
+    '''
+
+    __slots__ = ('dawg', 'offset', 'labels', 'mask', 'terminal')
+
+    def __init__(self, dawg, offset):
+        self.dawg = dawg
+        self.offset = offset
+        labels = dawg.labels[offset] or dawg.decode(offset)
+        self.labels = labels
+        self.mask = labels >> 2
+        self.terminal = labels & 1
+
+    def link(self, label):
+        '''
+        Get the offset of the child on label, 0 past the end of a word.
+        '''
+        bit = EDGE_BITS[label]
+        labels = self.labels
+        if not labels & bit:
+            raise KeyError(label)
+        below = labels & (bit - 1)
+        return self.dawg.links[self.offset + POPCOUNT[below & 0x3fff] +
+            POPCOUNT[below >> 14]]
+
+    def child(self, label):
+        '''
+        Get the child node on label, which must be on the node.
+        '''
+        below = self.labels & (EDGE_BITS[label] - 1)
+        dawg = self.dawg
+        return DawgNode(dawg, dawg.links[self.offset +
+            POPCOUNT[below & 0x3fff] + POPCOUNT[below >> 14]])
+
+    def walk(self, letters):
+        '''
+        Get the node reached along letters, None if they leave the graph.
+        '''
+        dawg = self.dawg
+        table = dawg.labels
+        links = dawg.links
+        offset = self.offset
+        labels = self.labels
+        for letter in letters:
+            bit = EDGE_BITS.get(letter, 0)
+            if not labels & bit:
+                return None
+            below = labels & (bit - 1)
+            offset = links[offset + POPCOUNT[below & 0x3fff] +
+                POPCOUNT[below >> 14]]
+            labels = table[offset] or dawg.decode(offset)
+        return DawgNode(dawg, offset)
+
+    def __contains__(self, label):
+        return bool(self.labels & EDGE_BITS.get(label, 0))
+
+    def __getitem__(self, label):
+        link = self.link(label)
+        if not link:
+            return None
+        return DawgNode(self.dawg, link)
+
+    def __iter__(self):
+        labels = self.labels
+        while labels:
+            bit = labels & -labels
+            labels ^= bit
+            yield EDGE_LABELS[bit.bit_length() - 1]
+
+    def __len__(self):
+        labels = self.labels
+        return POPCOUNT[labels & 0x3fff] + POPCOUNT[labels >> 14]
+
+
+class Dawg(object):
+    '''
+    Packed dawg file read in place through mmap.
+
+    The file is a flat array of little-endian 4-byte edges: bits 0-23 hold
+    the index of the child node, bits 24-30 the letter and bit 31 is set
+    when more edges of the same node follow. The edges of a node are
+    sorted by label. Versioned files put a header in front of the array
+    (see lexicon_layout). The mapping is read-only, so every process on
+    the host shares the same lexicon pages. Besides them a process keeps,
+    per edge, the 4-byte label set of the node starting there, the 4-byte
+    child offset and a byte of depth, all filled on demand.
+    '''
+
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is None:
+            with open(path, 'rb') as fp:
+                self.data = mmap.mmap(
+                    fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = data
+        self.base, self.size, self.kind = lexicon_layout(self.data, path)
+        if self.kind == LEXICON_ANAGRAM:
+            raise ValueError('Not a dawg: %s.' % path)
+        self.labels = array.array('I', [0]) * self.size
+        self.links = array.array('I', [0]) * self.size
+        self.depths = None
+        self.root = self.node(0)
+
+    def node(self, offset):
+        return DawgNode(self, offset)
+
+    def decode(self, offset):
+        '''
+        Get the label set of the node at offset, from its edges, and store
+        the child offsets of the edges.
+        '''
+        labels = 0
+        index = offset
+        while True:
+            x = EDGE.unpack_from(self.data, self.base + index * 4)[0]
+            label = chr((x >> 24) & 0x7f)
+            if label not in EDGE_BITS:
+                raise ValueError('Unsupported label %r in %s.' % (
+                    label, self.path))
+            labels |= EDGE_BITS[label]
+            self.links[index] = x & 0xffffff
+            if not (x >> 31) & 1:
+                break
+            index += 1
+        self.labels[offset] = labels
+        return labels
+
+    def depth(self, offset):
+        '''
+        Get the number of letters of the longest word ending below the
+        node at offset.
+        '''
+        if self.depths is None:
+            self.depths = array.array('B', [UNKNOWN_DEPTH]) * self.size
+        depth = self.depths[offset]
+        if depth == UNKNOWN_DEPTH:
+            labels = self.labels[offset] or self.decode(offset)
+            # the sentinel edge, if any, comes first
+            depth = 0
+            for index in xrange(offset + (labels & 1), offset +
+                    POPCOUNT[labels & 0x3fff] + POPCOUNT[labels >> 14]):
+                depth = max(depth, 1 + self.depth(self.links[index]))
+            self.depths[offset] = depth
+        return depth
+
+    def close(self):
+        self.labels = None
+        self.links = None
+        self.depths = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def map_dawg(path):
+    '''
+    Map dawg file, return the root node.
+    '''
+    return Dawg(path).root
+
+
+def iter_words(dawg):
+    '''
+    Enumerate dawg words in alphabetical order.
+
+    Takes the root of a mapped dawg or of the dicts of load_dawg.
+    '''
+    stack = [(dawg, '')]
+    while stack:
+        node, prefix = stack.pop()
+        for letter in sorted(node, reverse=True):
+            if letter == SENTINEL:
+                yield prefix
+            else:
+                stack.append((node[letter], prefix + letter))
+
+
+def build_graph(strings):
+    '''
+    Build a minimal acyclic automaton from sorted strings.
+
+    Nodes are plain dicts. Equivalent subtrees are merged as soon as the
+    next string leaves them, so memory stays close to the final size.
+    '''
+    root = {}
+    register = {}
+    unchecked = []
+    previous = ''
+
+    def minimize(depth):
+        while len(unchecked) > depth:
+            parent, letter, child = unchecked.pop()
+            key = tuple(sorted(
+                (label, id(node)) for label, node in child.iteritems()))
+            if key in register:
+                parent[letter] = register[key]
+            else:
+                register[key] = child
+
+    for string in strings:
+        common = len(os.path.commonprefix([previous, string]))
+        minimize(common)
+        node = unchecked[-1][2] if unchecked else root
+        for letter in string[common:]:
+            child = {}
+            node[letter] = child
+            unchecked.append((node, letter, child))
+            node = child
+        previous = string
+    minimize(0)
+    return root
+
+
+def pack_graph(root):
+    '''
+    Pack a dict graph into the 4-byte edge format of the dawg files.
+    '''
+    offsets = {id(root): 0}
+    order = [root]
+    size = len(root)
+    for node in order:
+        for letter in sorted(node):
+            child = node[letter]
+            if child and id(child) not in offsets:
+                offsets[id(child)] = size
+                order.append(child)
+                size += len(child)
+    if size > 0xffffff:
+        raise ValueError('Graph too large: %d edges.' % size)
+    data = array.array('I')
+    for node in order:
+        letters = sorted(node)
+        for letter in letters:
+            child = node[letter]
+            x = (offsets[id(child)] if child else 0) | (ord(letter) << 24)
+            if letter != letters[-1]:
+                x |= 1 << 31
+            data.append(x)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data
+
+
+def gaddag_strings(word):
+    '''
+    Gaddag paths of a word: reversed prefix, separator, suffix.
+    '''
+    for index in xrange(1, len(word) + 1):
+        yield word[index - 1::-1] + SEPARATOR + word[index:] + SENTINEL
+
+
+def target_dawg(words):
+    '''
+    Build an in-memory dawg of a few target words, None without words.
+    '''
+    strings = sorted(set(word + SENTINEL for word in words))
+    if not strings:
+        return None
+    return Dawg(None, pack_graph(build_graph(strings)).tostring()).root
+
+
+def build_dawg(words, path):
+    '''
+    Build dawg file from words.
+    '''
+    strings = sorted(set(word + SENTINEL for word in words))
+    write_lexicon(path, pack_graph(build_graph(strings)), LEXICON_DAWG)
+
+
+def build_gaddag(words, path):
+    '''
+    Build gaddag file from words.
+    '''
+    strings = []
+    for word in words:
+        strings.extend(gaddag_strings(word))
+    strings.sort()
+    write_lexicon(path, pack_graph(build_graph(strings)), LEXICON_GADDAG)
+
+
+def gaddag_path(lexicon):
+    '''
+    Path of the gaddag of a dawg path, next to it.
+    '''
+    return os.path.splitext(lexicon)[0] + '.gaddag'
+
+
+def load_gaddag(path):
+    '''
+    Map gaddag file, built offline by `lexicon.py index`.
+    '''
+    if not os.path.exists(path):
+        raise IOError('Missing gaddag %s, build it with: '
+            'python lexicon.py index' % path)
+    return map_dawg(path)
+
+
+def signature(letters):
+    '''
+    Anagram signature: the letters sorted.
+    '''
+    return ''.join(sorted(letters))
+
+
+class AnagramIndex(object):
+    '''
+    Words of RACK_SIZE and RACK_SIZE + 1 letters by signature, read in
+    place through mmap.
+
+    Records are fixed width and sorted by signature, so a lookup is a
+    binary search of about 16 probes over the whole lexicon.
+    '''
+
+    RECORD = ANAGRAM_WIDTH * 2
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base, self.size, kind = lexicon_layout(self.data, path)
+        if kind != LEXICON_ANAGRAM:
+            self.data.close()
+            raise ValueError('Not an anagram index: %s.' % path)
+
+    def lookup(self, key):
+        '''
+        Get the words of a signature.
+        '''
+        data = self.data
+        key = key.ljust(ANAGRAM_WIDTH, '\0')
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) / 2
+            start = self.base + middle * self.RECORD
+            if data[start:start + ANAGRAM_WIDTH] < key:
+                low = middle + 1
+            else:
+                high = middle
+        words = []
+        start = self.base + low * self.RECORD
+        while low < self.size and \
+                data[start:start + ANAGRAM_WIDTH] == key:
+            words.append(data[start + ANAGRAM_WIDTH:
+                start + self.RECORD].rstrip('\0'))
+            start += self.RECORD
+            low += 1
+        return words
+
+    def words(self, tiles, extra=''):
+        '''
+        Get the words made of all tiles, or of all tiles and one of the
+        extra letters, blanks standing for any letter.
+        '''
+        tiles = [tile.lower() for tile in tiles]
+        result = set()
+        for letters in [tiles] + [tiles + [letter]
+                for letter in set(extra.lower())]:
+            fixed = [tile for tile in letters if tile != WILD]
+            for fill in itertools.combinations_with_replacement(
+                    ALPHABET, len(letters) - len(fixed)):
+                result.update(self.lookup(signature(fixed + list(fill))))
+        return result
+
+    def close(self):
+        self.data.close()
+
+
+def build_anagrams(words, path):
+    '''
+    Build anagram index file from words.
+    '''
+    records = sorted(set(
+        signature(word).ljust(ANAGRAM_WIDTH, '\0') +
+            word.ljust(ANAGRAM_WIDTH, '\0')
+        for word in words if RACK_SIZE <= len(word) <= ANAGRAM_WIDTH))
+    write_lexicon(path, ''.join(records), LEXICON_ANAGRAM)
+
+
+def anagrams_path(lexicon):
+    '''
+    Path of the anagram index of a dawg path, next to it.
+    '''
+    return os.path.splitext(lexicon)[0] + '.anagram'
+
+
+def load_anagrams(path):
+    '''
+    Map anagram index file, built offline by `lexicon.py index`.
+    '''
+    if not os.path.exists(path):
+        raise IOError('Missing anagram index %s, build it with: '
+            'python lexicon.py index' % path)
+    return AnagramIndex(path)
+
+
 def check_dawg(dawg, word):
     '''
     Check dawg for supplied word.
     '''
-    word = '%s$' % word.lower()
-    node = dawg
-    for letter in word:
-        if letter in node:
-            node = node[letter]
+    node = dawg.walk(word.lower())
+    return node is not None and bool(node.terminal)
+
+
+def rack_counts(tiles):
+    '''
+    Count rack tiles in slots 0-25 for letters and BLANK for blanks.
+    '''
+    counts = [0] * (BLANK + 1)
+    for tile in tiles:
+        if tile == WILD:
+            counts[BLANK] += 1
         else:
-            return False
-    return True
+            counts[ord(tile.lower()) - ord('a')] += 1
+    return counts
+
+
+def rack_mask(counts):
+    '''
+    Get the bits of the letters the rack can play.
+    '''
+    if counts[BLANK]:
+        return ALL_LETTERS
+    mask = 0
+    for slot in xrange(BLANK):
+        if counts[slot]:
+            mask |= 1 << slot
+    return mask
 
 
 def key_letter(tile):
@@ -303,10 +1114,83 @@ def key_letter(tile):
     return (key, letter)
 
 
-def compute_move(board, dawg, x, y, direction, tiles):
+def _cross_check(board, dawg, x, y, px, py):
+    '''
+    Get the perpendicular word constraint of one square.
+    '''
+    if not board.is_empty(x, y):
+        return None
+    prefix = []
+    suffix = []
+    score = 0
+    sx, sy = x - px, y - py
+    while sx >= 0 and sy >= 0 and not board.is_empty(sx, sy):
+        key, letter = key_letter(board.get_tile(sx, sy))
+        prefix.insert(0, letter)
+        score += board.tile_value[key]
+        sx, sy = sx - px, sy - py
+    sx, sy = x + px, y + py
+    while sx < board.width and sy < board.height and \
+        not board.is_empty(sx, sy):
+        key, letter = key_letter(board.get_tile(sx, sy))
+        suffix.append(letter)
+        score += board.tile_value[key]
+        sx, sy = sx + px, sy + py
+    if not prefix and not suffix:
+        return None
+    prefix = ''.join(prefix)
+    suffix = ''.join(suffix)
+    mask = 0
+    node = dawg.walk(prefix)
+    if node is None:
+        return (0, score, prefix, suffix)
+    letters = node.mask
+    while letters:
+        bit = letters & -letters
+        letters ^= bit
+        if check_dawg(node.child(ALPHABET[bit.bit_length() - 1]), suffix):
+            mask |= bit
+    return (mask, score, prefix, suffix)
+
+
+def get_cross_checks(board, dawg, direction):
+    '''
+    Get perpendicular word constraints for a move direction.
+
+    An empty square with tiles next to it across the direction maps to
+    (mask, score, prefix, suffix): the bits of the letters that form a
+    valid perpendicular word there, the value of the tiles already in that
+    word and the letters before and after the square. Other squares map
+    to None.
+    '''
+    dx, dy = DIRECTION[direction]
+    px, py = int(not dx), int(not dy)
+    result = [None] * (board.width * board.height)
+    for y in xrange(board.height):
+        for x in xrange(board.width):
+            result[board.index(x, y)] = _cross_check(
+                board, dawg, x, y, px, py)
+    return result
+
+
+def _reject(reason):
+    '''
+    Count a compute_move rejection, return None.
+    '''
+    if STATS is not None:
+        STATS.count('rejected_%s' % reason)
+    return None
+
+
+def compute_move(board, dawg, x, y, direction, tiles, cross_checks=None):
     '''
     Do movement computation.
+
+    With cross_checks from get_cross_checks() the perpendicular words are
+    taken from the table instead of being walked and looked up again.
     '''
+    if STATS is not None:
+        STATS.count('compute_move')
     mx, my = x, y
     dx, dy = DIRECTION[direction]
     px, py = int(not dx), int(not dy)
@@ -320,17 +1204,17 @@ def compute_move(board, dawg, x, y, direction, tiles):
     # check for dangling tiles before word
     ax, ay = x - dx, y - dy
     if ax >= 0 and ay >= 0 and board.get_tile(ax, ay) != EMPTY:
-        return None
+        return _reject('dangling')
     for tile in tiles:
         # check for board run off
         if x < 0 or y < 0 or x >= board.width or y >= board.height:
-            return None
+            return _reject('run_off')
         adjacent = adjacent or board.is_adjacent(x, y)
         index = board.index(x, y)
         if tile == SKIP:
             tile = board.get_tile(x, y)
             if tile == EMPTY:
-                return None
+                return _reject('skip_empty')
             key, letter = key_letter(tile)
             main_word.append(letter)
             main_score += board.tile_value[key]
@@ -338,60 +1222,66 @@ def compute_move(board, dawg, x, y, direction, tiles):
             placed += 1
             key, letter = key_letter(tile)
             main_word.append(letter)
-            nx = (LEFT + x) % 14
-            ny = (TOP + y) % 14
-            original_index = ((y * 14) + x)
-            bonus_index = ((ny * 14) + nx)
             main_score += board.tile_value[key] * \
-                board.letter_multiplier[bonus_index]
-            multiplier *= board.word_multiplier[bonus_index]
-            # check for perpendicular word
-            sub_word = [letter]
-            sub_score = board.tile_value[key] * \
-                board.letter_multiplier[bonus_index]
-            n = 1
-            while True: # prefix
-                sx = x - px * n
-                sy = y - py * n
-                if sx < 0 or sy < 0:
-                    break
-                tile = board.get_tile(sx, sy)
-                if tile == EMPTY:
-                    break
-                key, letter = key_letter(tile)
-                sub_word.insert(0, letter)
-                sub_score += board.tile_value[key]
-                n += 1
-            n = 1
-            while True: # suffix
-                sx = x + px * n
-                sy = y + py * n
-                if sx >= board.width or sy >= board.height:
-                    break
-                tile = board.get_tile(sx, sy)
-                if tile == EMPTY:
-                    break
-                key, letter = key_letter(tile)
-                sub_word.append(letter)
-                sub_score += board.tile_value[key]
-                n += 1
-            if len(sub_word) > 1:
-                #sub_score *= board.word_multiplier[index]
-                sub_score *= board.word_multiplier[bonus_index]
-                sub_scores += sub_score
-                sub_word = ''.join(sub_word)
-                words.append(str(sub_word))
+                board.letter_premium[index]
+            multiplier *= board.word_premium[index]
+            if cross_checks is not None:
+                check = cross_checks[index]
+                if check is not None:
+                    mask, cross_score, prefix, suffix = check
+                    if not mask & LETTER_BITS[letter]:
+                        return _reject('cross_word')
+                    sub_scores += (board.tile_value[key] *
+                        board.letter_premium[index] +
+                        cross_score) * board.word_premium[index]
+                    words.append(prefix + letter + suffix)
+            else:
+                # check for perpendicular word
+                sub_word = [letter]
+                sub_score = board.tile_value[key] * \
+                    board.letter_premium[index]
+                n = 1
+                while True: # prefix
+                    sx = x - px * n
+                    sy = y - py * n
+                    if sx < 0 or sy < 0:
+                        break
+                    tile = board.get_tile(sx, sy)
+                    if tile == EMPTY:
+                        break
+                    key, letter = key_letter(tile)
+                    sub_word.insert(0, letter)
+                    sub_score += board.tile_value[key]
+                    n += 1
+                n = 1
+                while True: # suffix
+                    sx = x + px * n
+                    sy = y + py * n
+                    if sx >= board.width or sy >= board.height:
+                        break
+                    tile = board.get_tile(sx, sy)
+                    if tile == EMPTY:
+                        break
+                    key, letter = key_letter(tile)
+                    sub_word.append(letter)
+                    sub_score += board.tile_value[key]
+                    n += 1
+                if len(sub_word) > 1:
+                    sub_score *= board.word_premium[index]
+                    sub_scores += sub_score
+                    sub_word = ''.join(sub_word)
+                    words.append(str(sub_word))
         x += dx
         y += dy
     # check for dangling tiles after word
     if x < board.width and y < board.height and \
         board.get_tile(x, y) != EMPTY:
-        return None
+        return _reject('dangling')
     # check for placed tiles
     if not adjacent:
-        return None
+        return _reject('not_adjacent')
     if placed < 1 or placed > RACK_SIZE:
-        return None
+        return _reject('placed')
     # compute score
     main_score *= multiplier
     score = main_score + sub_scores
@@ -400,145 +1290,1214 @@ def compute_move(board, dawg, x, y, direction, tiles):
     main_word = ''.join(main_word)
     words.insert(0, str(main_word))
     # check words
-    for word in words:
+    if cross_checks is not None:
+        # perpendicular words are valid by construction
+        unchecked = words[:1]
+    else:
+        unchecked = words
+    for word in unchecked:
         if not check_dawg(dawg, word):
-            return None
+            if word is unchecked[0]:
+                return _reject('main_word')
+            return _reject('cross_word')
     # build result
+    if STATS is not None:
+        STATS.count('accepted')
     return Move(mx, my, direction, tiles, score, words)
 
-def get_horizontal_starts(board, tile_count):
-    '''
-    Get horizontal starting point.
+def _line_distances(board, x, y, dx, dy, result):
     '''
-    result = [0] * (board.width * board.height)
-    for y in xrange(board.height):
-        for x in xrange(board.width):
-            if x > 0 and not board.is_empty(x - 1, y):
-                continue
-            if board.is_empty(x, y):
-                for i in xrange(tile_count):
-                    if x + i < board.width and board.is_adjacent(x + i, y):
-                        result[board.index(x, y)] = i + 1
-                        break
-            else:
-                result[board.index(x, y)] = 1
-    return result
+    Fill starting point distances along one line.
 
-def get_vertical_starts(board, tile_count):
+    A starting point maps to one more than the offset of the first
+    adjacent square from it, others map to 0.
     '''
-    Get vertical starting point.
+    cells = []
+    while x < board.width and y < board.height:
+        cells.append((x, y))
+        x += dx
+        y += dy
+    adjacent = None
+    for offset in xrange(len(cells) - 1, -1, -1):
+        x, y = cells[offset]
+        if board.is_adjacent(x, y):
+            adjacent = offset
+        index = board.index(x, y)
+        if offset > 0 and not board.is_empty(x - dx, y - dy):
+            result[index] = 0
+        elif not board.is_empty(x, y):
+            result[index] = 1
+        elif adjacent is not None:
+            result[index] = adjacent - offset + 1
+        else:
+            result[index] = 0
+
+def _grid_distances(board, direction):
     '''
-    result = [0] * (board.width * board.height)
-    for y in xrange(board.height):
-        for x in xrange(board.width):
-            if y > 0 and not board.is_empty(x, y - 1):
-                continue
-            if board.is_empty(x, y):
-                for i in xrange(tile_count):
-                    if y + i < board.height and board.is_adjacent(x, y + i):
-                        result[board.index(x, y)] = i + 1
-                        break
-            else:
-                result[board.index(x, y)] = 1
-    return result
+    Get starting point distances of the whole board from the NumPy grid.
 
-def _generate(board, x, y, dx, dy, counts, node, tiles, min_tiles, results):
+    Same table as _line_distances() over every line, from array shifts.
+    '''
+    occupied = board.get_grid() != ord(EMPTY)
+    height, width = occupied.shape
+    # mirrors Board.is_adjacent()
+    adjacent = numpy.zeros_like(occupied)
+    adjacent[:, 1:] |= occupied[:, :-1]
+    adjacent[1:, :] |= occupied[:-1, :]
+    adjacent[:, :width - 2] |= occupied[:, 1:width - 1]
+    adjacent[:height - 2, :] |= occupied[1:height - 1, :]
+    if direction == VERTICAL:
+        occupied = occupied.T
+        adjacent = adjacent.T
+    size = occupied.shape[1]
+    offsets = numpy.arange(size)
+    # offset of the first adjacent square at or after each square
+    first = numpy.where(adjacent, offsets, size)
+    first = numpy.minimum.accumulate(first[:, ::-1], axis=1)[:, ::-1]
+    result = numpy.where(first < size, first - offsets + 1, 0)
+    result[occupied] = 1
+    result[:, 1:][occupied[:, :-1]] = 0
+    if direction == VERTICAL:
+        result = result.T
+    return result.ravel().tolist()
+
+def _generate(board, x, y, dx, dy, counts, letters, graph, node, tiles,
+        min_tiles, checks, results):
     '''
     Subprocess for generating movement candidates.
+
+    node is the offset of a node of graph. Only the letters both on the
+    node and on the rack are tried, taken lowest bit first from the
+    intersection of the masks.
     '''
-    if len(tiles) >= min_tiles and SENTINEL in node:
+    if STATS is not None:
+        STATS.count('nodes')
+    labels = graph.labels[node] or graph.decode(node)
+    if len(tiles) >= min_tiles and labels & 1:
         results.append(''.join(tiles))
     if x >= board.width or y >= board.height:
         return
-    tile = board.get_tile(x, y).lower()
+    index = board.index(x, y)
+    tile = board.tiles[index].lower()
+    links = graph.links
     if tile == EMPTY:
-        for tile in counts:
-            if counts[tile]:
-                if tile == WILD:
-                    for letter in xrange(26):
-                        tile = chr(ord('a') + letter)
-                        if tile in node:
-                            counts[WILD] -= 1
-                            tiles.append(tile.upper())
-                            _generate(board, x + dx, y + dy, dx, dy, counts,
-                                node[tile], tiles, min_tiles, results)
-                            tiles.pop()
-                            counts[WILD] += 1
-                else:
-                    if tile in node:
-                        counts[tile] -= 1
-                        tiles.append(tile)
-                        _generate(board, x + dx, y + dy, dx, dy, counts,
-                            node[tile], tiles, min_tiles, results)
-                        tiles.pop()
-                        counts[tile] += 1
+        check = checks[index]
+        mask = (labels >> 2) & letters
+        if check is not None:
+            mask &= check[0]
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            slot = bit.bit_length() - 1
+            if not counts[slot] and not counts[BLANK]:
+                continue
+            letter = ALPHABET[slot]
+            below = labels & ((bit << 2) - 1)
+            child = links[node + POPCOUNT[below & 0x3fff] +
+                POPCOUNT[below >> 14]]
+            if counts[slot]:
+                counts[slot] -= 1
+                tiles.append(letter)
+                _generate(board, x + dx, y + dy, dx, dy, counts, letters,
+                    graph, child, tiles, min_tiles, checks, results)
+                tiles.pop()
+                counts[slot] += 1
+            if counts[BLANK]:
+                counts[BLANK] -= 1
+                tiles.append(letter.upper())
+                _generate(board, x + dx, y + dy, dx, dy, counts, letters,
+                    graph, child, tiles, min_tiles, checks, results)
+                tiles.pop()
+                counts[BLANK] += 1
     else:
-        if tile in node:
+        bit = EDGE_BITS.get(tile, 0)
+        if labels & bit:
+            below = labels & (bit - 1)
             tiles.append(SKIP)
-            _generate(board, x + dx, y + dy, dx, dy, counts, node[tile],
-                tiles, min_tiles, results)
+            _generate(board, x + dx, y + dy, dx, dy, counts, letters, graph,
+                links[node + POPCOUNT[below & 0x3fff] +
+                    POPCOUNT[below >> 14]],
+                tiles, min_tiles, checks, results)
             tiles.pop()
 
-def generate(board, dawg, tiles):
+def get_lines(board):
     '''
-    Generate movement candidates.
+    List the (direction, line) pairs of the board, rows first.
     '''
-    moves = []
-    tiles = [letter.lower() for letter in tiles]
-    counts = dict((letter, tiles.count(letter)) for letter in set(tiles))
-    hstarts = get_horizontal_starts(board, len(tiles))
-    vstarts = get_vertical_starts(board, len(tiles))
-    for y in xrange(board.height):
-        for x in xrange(board.width):
-            index = board.index(x, y)
-            min_tiles = hstarts[index]
+    return [(HORIZONTAL, y) for y in xrange(board.height)] + \
+        [(VERTICAL, x) for x in xrange(board.width)]
+
+def line_cells(board, direction, line):
+    '''
+    Get the (x, y) squares of a line in move direction.
+    '''
+    if direction == HORIZONTAL:
+        return [(x, line) for x in xrange(board.width)]
+    return [(line, y) for y in xrange(board.height)]
+
+def generate_iter(board, dawg, tiles, lines=None, targets=None,
+        cross_checks=None):
+    '''
+    Generate movement candidates lazily.
+
+    Moves come out line by line in get_lines() order; lines limits the
+    search to some of them. With a targets dawg only the moves whose main
+    word is in it are searched, the other words are still checked against
+    dawg. cross_checks maps a direction to a table used instead of the
+    board's.
+    '''
+    counts = rack_counts(tiles)
+    letters = rack_mask(counts)
+    root = targets or dawg
+    starts = {}
+    for direction in (HORIZONTAL, VERTICAL):
+        starts[direction] = board.starts(direction, len(tiles))
+    for direction, line in lines or get_lines(board):
+        dx, dy = DIRECTION[direction]
+        checks = (cross_checks or {}).get(direction) or \
+            board.cross_checks(dawg, direction)
+        for x, y in line_cells(board, direction, line):
+            min_tiles = starts[direction][board.index(x, y)]
             if min_tiles:
-                direction = HORIZONTAL
-                dx, dy = DIRECTION[direction]
                 results = []
-                _generate(board, x, y, dx, dy, counts, dawg, [],
-                    min_tiles, results)
+                _generate(board, x, y, dx, dy, counts, letters, root.dawg,
+                    root.offset, [], min_tiles, checks, results)
                 for result in results:
                     move = compute_move(
-                        board, dawg, x, y, direction, result)
+                        board, dawg, x, y, direction, result, checks)
                     if move:
-                        moves.append(move)
-            min_tiles = vstarts[index]
+                        yield move
+
+def generate(board, dawg, tiles, lines=None):
+    '''
+    Generate movement candidates.
+    '''
+    return list(generate_iter(board, dawg, tiles, lines))
+
+def _generate_batch(board, x, y, dx, dy, used, active, above, letters,
+        graph, node, tiles, min_tiles, checks, results):
+    '''
+    Subprocess of _generate for several racks at once.
+
+    Racks are bits: active holds the racks that can still follow the path
+    and above[slot][count] the racks holding more than count tiles of a
+    slot. Every rack on a path has used the same tiles, counted in used,
+    so a branch goes on with active & above[slot][used[slot]] and each
+    rack sees the same paths as on its own.
+    '''
+    if STATS is not None:
+        STATS.count('nodes')
+    labels = graph.labels[node] or graph.decode(node)
+    if len(tiles) >= min_tiles and labels & 1:
+        results.append((''.join(tiles), active))
+    if x >= board.width or y >= board.height:
+        return
+    index = board.index(x, y)
+    tile = board.tiles[index].lower()
+    links = graph.links
+    if tile == EMPTY:
+        check = checks[index]
+        mask = (labels >> 2) & letters
+        if check is not None:
+            mask &= check[0]
+        blanks = active & above[BLANK][used[BLANK]]
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            slot = bit.bit_length() - 1
+            branch = active & above[slot][used[slot]]
+            if not branch and not blanks:
+                continue
+            letter = ALPHABET[slot]
+            below = labels & ((bit << 2) - 1)
+            child = links[node + POPCOUNT[below & 0x3fff] +
+                POPCOUNT[below >> 14]]
+            if branch:
+                used[slot] += 1
+                tiles.append(letter)
+                _generate_batch(board, x + dx, y + dy, dx, dy, used, branch,
+                    above, letters, graph, child, tiles, min_tiles, checks,
+                    results)
+                tiles.pop()
+                used[slot] -= 1
+            if blanks:
+                used[BLANK] += 1
+                tiles.append(letter.upper())
+                _generate_batch(board, x + dx, y + dy, dx, dy, used, blanks,
+                    above, letters, graph, child, tiles, min_tiles, checks,
+                    results)
+                tiles.pop()
+                used[BLANK] -= 1
+    else:
+        bit = EDGE_BITS.get(tile, 0)
+        if labels & bit:
+            below = labels & (bit - 1)
+            tiles.append(SKIP)
+            _generate_batch(board, x + dx, y + dy, dx, dy, used, active,
+                above, letters, graph, links[node +
+                    POPCOUNT[below & 0x3fff] + POPCOUNT[below >> 14]],
+                tiles, min_tiles, checks, results)
+            tiles.pop()
+
+def generate_batch(board, dawg, racks):
+    '''
+    Generate movement candidates for several racks in one board walk.
+
+    Start tables and cross-checks are built once, the dawg is walked once
+    per start with all the racks, and every path that ends in a word is
+    scored once whatever the number of racks playing it. Returns one move
+    list per rack, each the same as generate() on its own.
+    '''
+    if not racks:
+        return []
+    # identical racks share a bit
+    unique = sorted(set(''.join(sorted(tiles)) for tiles in racks))
+    size = max(len(tiles) for tiles in unique)
+    letters = 0
+    above = [[0] * (size + 1) for slot in xrange(BLANK + 1)]
+    for number, tiles in enumerate(unique):
+        counts = rack_counts(tiles)
+        letters |= rack_mask(counts)
+        for slot in xrange(BLANK + 1):
+            for count in xrange(counts[slot]):
+                above[slot][count] |= 1 << number
+    moves = [[] for tiles in unique]
+    starts = {}
+    for direction in (HORIZONTAL, VERTICAL):
+        starts[direction] = board.starts(direction, size)
+    for direction, line in get_lines(board):
+        dx, dy = DIRECTION[direction]
+        checks = board.cross_checks(dawg, direction)
+        for x, y in line_cells(board, direction, line):
+            min_tiles = starts[direction][board.index(x, y)]
             if min_tiles:
-                direction = VERTICAL
-                dx, dy = DIRECTION[direction]
-                results = []
-                _generate(board, x, y, dx, dy, counts, dawg, [],
-                    min_tiles, results)
-                for result in results:
+                paths = []
+                _generate_batch(board, x, y, dx, dy, [0] * (BLANK + 1),
+                    (1 << len(unique)) - 1, above, letters, dawg.dawg,
+                    dawg.offset, [], min_tiles, checks, paths)
+                for path, numbers in paths:
                     move = compute_move(
-                        board, dawg, x, y, direction, result)
+                        board, dawg, x, y, direction, path, checks)
                     if move:
-                        moves.append(move)
-    return moves
+                        while numbers:
+                            rack = numbers & -numbers
+                            numbers ^= rack
+                            moves[rack.bit_length() - 1].append(move)
+    return [moves[unique.index(''.join(sorted(tiles)))] for tiles in racks]
+
+def get_anchors(board, starts, dx, dy):
+    '''
+    Map each anchor to the starting points it is the first adjacent
+    square of.
+    '''
+    anchors = {}
+    for y in xrange(board.height):
+        for x in xrange(board.width):
+            index = board.index(x, y)
+            min_tiles = starts[index]
+            if min_tiles:
+                anchor = board.index(
+                    x + dx * (min_tiles - 1), y + dy * (min_tiles - 1))
+                anchors.setdefault(anchor, set()).add(index)
+    return anchors
+
+def _rack_letters(counts, letters, labels, check):
+    '''
+    List (slot, label bit, tile) the rack can play on a node of labels.
+    '''
+    mask = (labels >> 2) & letters
+    if check is not None:
+        mask &= check[0]
+    result = []
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        slot = bit.bit_length() - 1
+        letter = ALPHABET[slot]
+        if counts[slot]:
+            result.append((slot, bit << 2, letter))
+        if counts[BLANK]:
+            result.append((BLANK, bit << 2, letter.upper()))
+    return result
+
+def _generate_prefix(board, x, y, dx, dy, counts, letters, graph, node,
+        tiles, anchor, starts, checks, results):
+    '''
+    Subprocess for laying tiles backwards from the anchor.
+    '''
+    if STATS is not None:
+        STATS.count('nodes')
+    labels = graph.labels[node] or graph.decode(node)
+    index = board.index(x, y)
+    tile = board.tiles[index].lower()
+    if tile == EMPTY:
+        choices = _rack_letters(counts, letters, labels, checks[index])
+    elif labels & EDGE_BITS.get(tile, 0):
+        choices = [(None, EDGE_BITS[tile], SKIP)]
+    else:
+        return
+    links = graph.links
+    ax, ay = anchor
+    px, py = x - dx, y - dy
+    forward = px >= 0 and py >= 0 and board.index(px, py) in starts
+    for slot, bit, tile in choices:
+        below = labels & (bit - 1)
+        child = links[node + POPCOUNT[below & 0x3fff] +
+            POPCOUNT[below >> 14]]
+        if slot is not None:
+            counts[slot] -= 1
+        tiles.append(tile)
+        found = graph.labels[child] or graph.decode(child)
+        if found & EDGE_BITS[SEPARATOR]:
+            # only the sentinel edge can come before the separator
+            _generate_suffix(board, ax + dx, ay + dy, dx, dy, counts,
+                letters, graph, links[child + (found & 1)], tiles[::-1],
+                x, y, checks, results)
+        if forward:
+            _generate_prefix(board, px, py, dx, dy, counts, letters, graph,
+                child, tiles, anchor, starts, checks, results)
+        tiles.pop()
+        if slot is not None:
+            counts[slot] += 1
+
+def _generate_suffix(board, x, y, dx, dy, counts, letters, graph, node,
+        tiles, sx, sy, checks, results):
+    '''
+    Subprocess for laying tiles forwards past the anchor.
+    '''
+    if STATS is not None:
+        STATS.count('nodes')
+    labels = graph.labels[node] or graph.decode(node)
+    outside = x >= board.width or y >= board.height
+    if labels & 1 and (outside or board.is_empty(x, y)):
+        results.append((sx, sy, ''.join(tiles)))
+    if outside:
+        return
+    index = board.index(x, y)
+    tile = board.tiles[index].lower()
+    links = graph.links
+    if tile == EMPTY:
+        for slot, bit, tile in _rack_letters(
+                counts, letters, labels, checks[index]):
+            below = labels & (bit - 1)
+            counts[slot] -= 1
+            tiles.append(tile)
+            _generate_suffix(board, x + dx, y + dy, dx, dy, counts, letters,
+                graph, links[node + POPCOUNT[below & 0x3fff] +
+                    POPCOUNT[below >> 14]],
+                tiles, sx, sy, checks, results)
+            tiles.pop()
+            counts[slot] += 1
+    else:
+        bit = EDGE_BITS.get(tile, 0)
+        if labels & bit:
+            below = labels & (bit - 1)
+            tiles.append(SKIP)
+            _generate_suffix(board, x + dx, y + dy, dx, dy, counts, letters,
+                graph, links[node + POPCOUNT[below & 0x3fff] +
+                    POPCOUNT[below >> 14]],
+                tiles, sx, sy, checks, results)
+            tiles.pop()
+
+def generate_gaddag_iter(board, gaddag, dawg, tiles, lines=None):
+    '''
+    Generate movement candidates lazily by growing words around anchors.
+
+    Every move is generated once, from the first adjacent square of its
+    starting point, so the result is the same as generate_iter().
+    '''
+    counts = rack_counts(tiles)
+    letters = rack_mask(counts)
+    anchors = {}
+    for direction in (HORIZONTAL, VERTICAL):
+        dx, dy = DIRECTION[direction]
+        anchors[direction] = get_anchors(
+            board, board.starts(direction, len(tiles)), dx, dy)
+    for direction, line in lines or get_lines(board):
+        dx, dy = DIRECTION[direction]
+        checks = board.cross_checks(dawg, direction)
+        for ax, ay in line_cells(board, direction, line):
+            index = board.index(ax, ay)
+            if index not in anchors[direction]:
+                continue
+            results = []
+            _generate_prefix(board, ax, ay, dx, dy, counts, letters,
+                gaddag.dawg, gaddag.offset, [], (ax, ay),
+                anchors[direction][index], checks, results)
+            for x, y, result in results:
+                move = compute_move(
+                    board, dawg, x, y, direction, result, checks)
+                if move:
+                    yield move
+
+def generate_gaddag(board, gaddag, dawg, tiles, lines=None):
+    '''
+    Generate movement candidates by growing words around anchors.
+    '''
+    return list(generate_gaddag_iter(board, gaddag, dawg, tiles, lines))
+
+class TopMoves(object):
+    '''
+    Best moves by Move.key, bounded to size.
+
+    Ties keep arrival order, as a stable sort of all moves would.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, move):
+        '''
+        Add a move, timed as sort with instrumentation on.
+        '''
+        if STATS is None:
+            return self._push(move)
+        start = time.time()
+        self._push(move)
+        STATS.add_time('sort', time.time() - start)
+
+    def _push(self, move):
+        self.count += 1
+        entry = (move.key, self.count, move)
+        if len(self.entries) >= self.size:
+            if entry > self.entries[-1]:
+                return
+            self.entries.pop()
+        bisect.insort(self.entries, entry)
+
+    def extend(self, moves):
+        for move in moves:
+            self.push(move)
+
+    def moves(self):
+        return [entry[2] for entry in self.entries]
+
+def top_moves(moves, size):
+    '''
+    Get the best moves of an iterable, sorted by Move.key.
+    '''
+    top = TopMoves(size)
+    top.extend(moves)
+    return top.moves()
+
+class BestMove(object):
+    '''
+    Branch-and-bound search for the highest scoring move.
+
+    The main word, its multiplier and the perpendicular words are scored
+    as the walk goes. A branch is cut when the tiles left on the rack,
+    laid on the squares it could still reach with the most valuable tile
+    on the best premium, cannot match the best move found so far.
+    Starting points are tried in order of that bound, and ties are broken
+    as top_moves(generate_iter(...), 1) would break them.
+    '''
+
+    def __init__(self, board, dawg, tiles):
+        self.board = board
+        self.dawg = dawg
+        self.graph = dawg.dawg
+        self.size = len(tiles)
+        self.counts = rack_counts(tiles)
+        self.letters = rack_mask(self.counts)
+        # values of the tiles left on the rack, highest first
+        self.values = sorted((board.tile_value[key_letter(tile)[0]]
+            for tile in tiles), reverse=True)
+        self.letter_multiplier = board.letter_premium
+        self.word_multiplier = board.word_premium
+        self.best = None
+        self.score = -1
+
+    def search(self):
+        board = self.board
+        tables = dict((direction, board.starts(direction, self.size))
+            for direction in (HORIZONTAL, VERTICAL))
+        starts = []
+        for rank, (direction, line) in enumerate(get_lines(board)):
+            self.direction = direction
+            self.dx, self.dy = DIRECTION[direction]
+            self.checks = board.cross_checks(self.dawg, direction)
+            for x, y in line_cells(board, direction, line):
+                min_tiles = tables[direction][board.index(x, y)]
+                if min_tiles:
+                    starts.append((-self.bound(x, y, self.dawg.offset,
+                        0, 1, 0, 0),
+                        (rank, x, y), direction, min_tiles))
+        starts.sort()
+        for bound, rank, direction, min_tiles in starts:
+            if -bound < self.score:
+                break
+            self.rank = rank
+            self.direction = direction
+            self.dx, self.dy = DIRECTION[direction]
+            self.checks = board.cross_checks(self.dawg, direction)
+            self.min_tiles = min_tiles
+            self.start = rank[1:]
+            self._search(rank[1], rank[2], self.dawg.offset, [], 0, 1, 0,
+                0)
+        if self.best is None:
+            return None
+        return self.best[2]
+
+    def bound(self, x, y, node, main, multiplier, cross, placed):
+        '''
+        Get the most a word from (x, y) onwards could score, node being
+        the offset reached in the dawg.
+        '''
+        board = self.board
+        squares = []
+        length = self.graph.depth(node)
+        while length and x < board.width and y < board.height:
+            length -= 1
+            index = board.index(x, y)
+            tile = board.tiles[index]
+            if tile == EMPTY:
+                check = self.checks[index]
+                if placed >= self.size or \
+                    (check is not None and not check[0]):
+                    break
+                placed += 1
+                multiplier *= self.word_multiplier[index]
+                if check is not None:
+                    cross += check[1] * self.word_multiplier[index]
+                    squares.append((index, self.word_multiplier[index]))
+                else:
+                    squares.append((index, 0))
+            else:
+                main += board.tile_value[key_letter(tile)[0]]
+            x += self.dx
+            y += self.dy
+        # pair the highest values with the highest square coefficients
+        coefficients = sorted((self.letter_multiplier[index] *
+            (multiplier + word_multiplier)
+            for index, word_multiplier in squares), reverse=True)
+        tiles = sum(value * coefficient
+            for value, coefficient in zip(self.values, coefficients))
+        return main * multiplier + cross + tiles + \
+            (BINGO if placed == RACK_SIZE else 0)
+
+    def _search(self, x, y, node, tiles, main, multiplier, cross, placed):
+        if STATS is not None:
+            STATS.count('nodes')
+        board = self.board
+        if self.bound(x, y, node, main, multiplier, cross, placed) < \
+            self.score:
+            return
+        graph = self.graph
+        labels = graph.labels[node] or graph.decode(node)
+        if len(tiles) >= self.min_tiles and labels & 1:
+            score = main * multiplier + cross + \
+                (BINGO if placed == RACK_SIZE else 0)
+            if score >= self.score:
+                sx, sy = self.start
+                move = compute_move(board, self.dawg, sx, sy,
+                    self.direction, ''.join(tiles), self.checks)
+                if move and (self.best is None or
+                        (move.key, self.rank) < self.best[:2]):
+                    self.best = (move.key, self.rank, move)
+                    self.score = move.score
+        if x >= board.width or y >= board.height:
+            return
+        index = board.index(x, y)
+        tile = board.tiles[index]
+        nx, ny = x + self.dx, y + self.dy
+        if tile == EMPTY:
+            check = self.checks[index]
+            mask = (labels >> 2) & self.letters
+            if check is not None:
+                mask &= check[0]
+            counts = self.counts
+            links = graph.links
+            letter_multiplier = self.letter_multiplier[index]
+            word_multiplier = self.word_multiplier[index]
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                slot = bit.bit_length() - 1
+                letter = ALPHABET[slot]
+                below = labels & ((bit << 2) - 1)
+                child = links[node + POPCOUNT[below & 0x3fff] +
+                    POPCOUNT[below >> 14]]
+                for key in (slot, BLANK):
+                    if not counts[key]:
+                        continue
+                    value = board.tile_value[WILD if key == BLANK else letter]
+                    score = value * letter_multiplier
+                    sub_score = cross
+                    if check is not None:
+                        sub_score += (score + check[1]) * word_multiplier
+                    counts[key] -= 1
+                    self.values.remove(value)
+                    tiles.append(letter if key != BLANK else letter.upper())
+                    self._search(nx, ny, child, tiles, main + score,
+                        multiplier * word_multiplier, sub_score, placed + 1)
+                    tiles.pop()
+                    self.values.append(value)
+                    self.values.sort(reverse=True)
+                    counts[key] += 1
+        else:
+            key, letter = key_letter(tile)
+            bit = EDGE_BITS[letter]
+            if labels & bit:
+                below = labels & (bit - 1)
+                tiles.append(SKIP)
+                self._search(nx, ny, graph.links[node +
+                    POPCOUNT[below & 0x3fff] + POPCOUNT[below >> 14]], tiles,
+                    main + board.tile_value[key], multiplier, cross, placed)
+                tiles.pop()
+
+def best_move(board, letters, lexicon=None):
+    '''
+    Get the highest scoring move, or None.
+    '''
+    return BestMove(board, get_dawg(lexicon), letters).search()
+
+# Guards the lexicon caches below, shared by the account threads
+LEXICON_LOCK = threading.RLock()
+DAWGS = {}
+GADDAGS = {}
+ANAGRAMS = {}
+TARGETS = {}
+POOL = None
+POOL_LOCK = threading.Lock()
+# Pool worker boards by (lexicon, bounds), updated in place between tasks
+WORKER_BOARDS = {}
+
+def get_dawg(lexicon=None):
+    '''
+    Get the dawg of a lexicon path, mapped on first use.
+    '''
+    lexicon = lexicon or LEXICON
+    with LEXICON_LOCK:
+        if lexicon not in DAWGS:
+            DAWGS[lexicon] = map_dawg(lexicon)
+        return DAWGS[lexicon]
+
+def get_gaddag(lexicon=None):
+    '''
+    Get the gaddag of a lexicon path, mapped on first use.
+    '''
+    lexicon = lexicon or LEXICON
+    with LEXICON_LOCK:
+        if lexicon not in GADDAGS:
+            GADDAGS[lexicon] = load_gaddag(gaddag_path(lexicon))
+        return GADDAGS[lexicon]
+
+def get_anagrams(lexicon=None):
+    '''
+    Get the anagram index of a lexicon path, mapped on first use.
+    '''
+    lexicon = lexicon or LEXICON
+    with LEXICON_LOCK:
+        if lexicon not in ANAGRAMS:
+            ANAGRAMS[lexicon] = load_anagrams(anagrams_path(lexicon))
+        return ANAGRAMS[lexicon]
+
+def get_targets(words=None, long_words=False, lexicon=None):
+    '''
+    Get the target dawg of some words, or of the lexicon words of
+    LONG_WORD letters or more, built on first use.
+    '''
+    lexicon = lexicon or LEXICON
+    if long_words:
+        key = (lexicon, LONG_WORD)
+    else:
+        key = (lexicon, frozenset(words or ()))
+    with LEXICON_LOCK:
+        if key not in TARGETS:
+            if len(TARGETS) >= 16:
+                TARGETS.clear()
+            if long_words:
+                words = (word for word in iter_words(get_dawg(lexicon))
+                    if len(word) >= LONG_WORD)
+            TARGETS[key] = target_dawg(words or ())
+        return TARGETS[key]
+
+def iter_target_moves(board, letters, words=None, long_words=False,
+        lexicon=None):
+    '''
+    Generate only the moves forming one of words, or a long word.
+
+    Moves whose main word is a target come from a walk of a small dawg of
+    the targets instead of the lexicon. A target formed across comes from
+    a walk of the lexicon on the line of its square, with the square
+    narrowed to the letters completing the target.
+    '''
+    targets = get_targets(words, long_words, lexicon)
+    if targets is None:
+        return
+    dawg = get_dawg(lexicon)
+    seen = set()
+    for move in generate_iter(board, dawg, letters, targets=targets):
+        seen.add((move.x, move.y, move.direction, move.tiles))
+        yield move
+    rack = rack_mask(rack_counts(letters))
+    for direction in (HORIZONTAL, VERTICAL):
+        checks = board.cross_checks(dawg, direction)
+        for index, check in enumerate(checks):
+            if check is None:
+                continue
+            mask, score, prefix, suffix = check
+            mask &= rack
+            narrowed = 0
+            while mask:
+                bit = mask & -mask
+                mask ^= bit
+                if check_dawg(targets,
+                        prefix + ALPHABET[bit.bit_length() - 1] + suffix):
+                    narrowed |= bit
+            if not narrowed:
+                continue
+            table = list(checks)
+            table[index] = (narrowed, score, prefix, suffix)
+            x, y = index % board.width, index / board.width
+            line = y if direction == HORIZONTAL else x
+            for move in generate_iter(board, dawg, letters,
+                    [(direction, line)], cross_checks={direction: table}):
+                key = (move.x, move.y, move.direction, move.tiles)
+                if key not in seen and \
+                    any(check_dawg(targets, word) for word in move.words):
+                    seen.add(key)
+                    yield move
+
+def iter_bingo_moves(board, letters, lexicon=None):
+    '''
+    Generate the moves playing the whole rack as a word of RACK_SIZE
+    letters, or of RACK_SIZE + 1 through one tile on the board.
+
+    Candidate words come from the anagram index, per line for the letters
+    on it; only lines with candidates are walked, on a dawg of those.
+    Whole-rack plays through two tiles or more are not found: the index
+    only holds words of up to RACK_SIZE + 1 letters.
+    '''
+    if len(letters) != RACK_SIZE:
+        return
+    anagrams = get_anagrams(lexicon)
+    rack = anagrams.words(letters)
+    found = {}
+    words = set(rack)
+    lines = []
+    for direction, line in get_lines(board):
+        tiles = set(board.tiles[board.index(x, y)].lower()
+            for x, y in line_cells(board, direction, line))
+        tiles.discard(EMPTY)
+        for tile in tiles:
+            if tile not in found:
+                found[tile] = anagrams.words(letters, tile)
+                words.update(found[tile])
+        if rack or any(found[tile] for tile in tiles):
+            lines.append((direction, line))
+    targets = target_dawg(words)
+    if targets is None:
+        return
+    for move in generate_iter(board, get_dawg(lexicon), letters, lines,
+            targets):
+        if len(move.tiles) - move.tiles.count(SKIP) == RACK_SIZE:
+            yield move
+
+def get_pool(processes):
+    '''
+    Get the worker pool, forking it on first use.
+
+    Workers are forked after the first lexicon is mapped and share its
+    pages; lexicons mapped later are mapped by each worker on first use,
+    still backed by the same page cache. play_accounts forks it before
+    starting any thread, as a fork can copy a lock held by another thread.
+    '''
+    global POOL
+    with POOL_LOCK:
+        if POOL is None or POOL[0] != processes:
+            if POOL is not None:
+                POOL[1].terminate()
+            POOL = (processes, multiprocessing.Pool(processes))
+        return POOL[1]
+
+def _generate_lines(task):
+    '''
+    Pool worker: generate moves on a chunk of board lines.
+
+    The worker keeps its own board of the area and loads the shipped
+    tiles into it, so its tables are only refreshed around the squares
+    that changed since its last task. Moves go back as plain tuples,
+    which pickle several times faster than Move objects.
+    '''
+    tiles, letters, engine, lexicon, bounds, lines = task
+    key = (lexicon, bounds)
+    board = WORKER_BOARDS.get(key)
+    if board is None:
+        if len(WORKER_BOARDS) >= 4:
+            WORKER_BOARDS.clear()
+        board = WORKER_BOARDS[key] = Board(*bounds)
+    board.load(tiles)
+    return [(move.x, move.y, move.direction, move.tiles, move.score,
+            move.words)
+        for move in _iter_moves(board, letters, engine, lexicon, lines)]
+
+def _iter_moves(board, letters, engine, lexicon, lines=None):
+    if engine == 'gaddag':
+        return generate_gaddag_iter(board, get_gaddag(lexicon),
+            get_dawg(lexicon), letters, lines)
+    return generate_iter(board, get_dawg(lexicon), letters, lines)
+
+def generate_parallel(board, letters, engine, processes, lexicon=None):
+    '''
+    Generate moves lazily on a process pool, split by board lines.
+
+    Chunks are contiguous runs of get_lines() and are merged in order, so
+    the result is the same list as the in-process generator returns. Only
+    the tiles are shipped with each chunk, the workers keep the tables.
+    '''
+    lines = get_lines(board)
+    size = max(1, len(lines) / (processes * 4))
+    tiles = ''.join(board.tiles)
+    bounds = (board.left, board.top, board.width, board.height)
+    tasks = []
+    for start in xrange(0, len(lines), size):
+        tasks.append((tiles, letters, engine, lexicon, bounds,
+            lines[start:start + size]))
+    for result in get_pool(processes).imap(_generate_lines, tasks):
+        for move in result:
+            yield Move(*move)
+
+class MoveCache(object):
+    '''
+    LRU of search_moves results keyed by lexicon, board hash, viewport
+    and sorted rack.
+
+    Boards are told apart by their Zobrist hash, which makes a collision
+    possible in theory; 64 bits make it negligible for a few entries.
+    Only the best moves per category are kept, not the full move list: a
+    Move and its words take over 1 KB and a blank rack makes 100k moves.
+    '''
+
+    def __init__(self, size=MOVE_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, board, letters, lexicon=None):
+        return (lexicon or LEXICON, board.get_hash(), board.left % 14,
+            board.top % 14, board.width, board.height,
+            ''.join(sorted(letters)))
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+            else:
+                self.entries[key] = value
+                self.hits += 1
+        if STATS is not None:
+            STATS.count('move_cache_miss' if value is None else
+                'move_cache_hit')
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries),
+            'hits': self.hits, 'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+MOVE_CACHE = MoveCache()
+
+def iter_moves(board, letters, engine=None, processes=None, lexicon=None):
+    engine = engine or ENGINE
+    processes = processes or PROCESSES
+    lexicon = lexicon or LEXICON
+    if engine == 'gaddag':
+        get_gaddag(lexicon)
+    if processes > 1:
+        return generate_parallel(board, letters, engine, processes, lexicon)
+    return _iter_moves(board, letters, engine, lexicon)
+
+def generate_moves(board, letters, engine=None, processes=None,
+        lexicon=None):
+    return list(iter_moves(board, letters, engine, processes, lexicon))
+
+def search_moves(board, letters, size=TOP_MOVES, lexicon=None):
+    '''
+    Get the size best moves, the size best moves forming a long word and
+    the number of moves, memoised in MOVE_CACHE.
+    '''
+    lexicon = lexicon or LEXICON
+    key = None
+    if MOVE_CACHE.size:
+        key = MOVE_CACHE.key(board, letters, lexicon) + (size,)
+        result = MOVE_CACHE.get(key)
+        if result is not None:
+            return result
+    top = TopMoves(size)
+    long_words = TopMoves(size)
+    for move in iter_moves(board, letters, lexicon=lexicon):
+        top.push(move)
+        if any(len(word) >= LONG_WORD for word in move.words):
+            long_words.push(move)
+    result = (top.moves(), long_words.moves(), top.count)
+    if key is not None:
+        MOVE_CACHE.put(key, result)
+    return result
 
-DAWG = load_dawg('files/twl.dawg')
+def generate_moves_batch(board, racks, lexicon=None):
+    '''
+    Generate the moves of several racks on one board, e.g. to compare
+    racks before a swap_rack. Returns one move list per rack.
 
-def generate_moves(board, letters):
-    return generate(board, DAWG, letters)
+    The racks share a single walk of the board.
+    '''
+    return generate_batch(board, get_dawg(lexicon or LEXICON), racks)
 
 
 # Bot
+FETCH_POOL = None
+FETCH_POOL_LOCK = threading.Lock()
+
+def get_fetch_pool():
+    '''
+    Get the thread pool for concurrent fetches, shared by every player.
+    '''
+    global FETCH_POOL
+    with FETCH_POOL_LOCK:
+        if FETCH_POOL is None:
+            FETCH_POOL = multiprocessing.pool.ThreadPool(FETCH_THREADS)
+        return FETCH_POOL
+
+
+class ChunkCache(object):
+    '''
+    World tiles from tiles_for, in CHUNK_SIZE squares keyed by chunk.
+
+    A chunk is fetched whole, is served until it is older than the TTL and
+    is patched with our own plays in the meantime. Past max_age it is
+    dropped, so the cache only holds the world around recent turns.
+    Letters are kept lowercase, as tiles_for does not tell blanks apart.
+    '''
+
+    def __init__(self, size=CHUNK_SIZE, ttl=CHUNK_TTL, max_age=CHUNK_MAX_AGE):
+        self.size = size
+        self.ttl = ttl
+        self.max_age = max_age
+        # (cx, cy): (fetched, {(x, y): letter})
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def key(self, x, y):
+        return (x // self.size, y // self.size)
+
+    def keys(self, left, right, top, bottom):
+        '''
+        Chunks covering a world rectangle.
+        '''
+        (cl, cb), (cr, ct) = self.key(left, bottom), self.key(right, top)
+        return [(cx, cy)
+            for cy in xrange(cb, ct + 1) for cx in xrange(cl, cr + 1)]
+
+    def bounds(self, keys):
+        '''
+        World rectangle (left, right, top, bottom) covering chunks.
+        '''
+        size = self.size
+        return (
+            min(cx for cx, cy in keys) * size,
+            max(cx for cx, cy in keys) * size + size - 1,
+            max(cy for cx, cy in keys) * size + size - 1,
+            min(cy for cx, cy in keys) * size)
+
+    def missing(self, keys):
+        now = time.time()
+        with self.lock:
+            return [key for key in keys if key not in self.chunks or
+                now - self.chunks[key][0] > self.max_age]
+
+    def stale(self, keys):
+        now = time.time()
+        with self.lock:
+            return [key for key in keys if key not in self.chunks or
+                now - self.chunks[key][0] > self.ttl]
+
+    def store(self, keys, tiles, fetched):
+        '''
+        Replace chunks with the (x, y, letter) tiles fetched over them,
+        dropping the chunks past max_age.
+        '''
+        with self.lock:
+            for key, chunk in self.chunks.items():
+                if fetched - chunk[0] > self.max_age:
+                    del self.chunks[key]
+            for key in keys:
+                self.chunks[key] = (fetched, {})
+            for x, y, letter in tiles:
+                key = self.key(x, y)
+                if key in self.chunks:
+                    self.chunks[key][1][(x, y)] = letter
+
+    def patch(self, tiles):
+        '''
+        Add our own (x, y, letter) tiles to the chunks we hold.
+        '''
+        with self.lock:
+            for x, y, letter in tiles:
+                key = self.key(x, y)
+                if key in self.chunks:
+                    self.chunks[key][1][(x, y)] = letter.lower()
+
+    def invalidate(self, cells):
+        '''
+        Drop the chunks holding any of the (x, y) cells.
+        '''
+        with self.lock:
+            for x, y in cells:
+                self.chunks.pop(self.key(x, y), None)
+
+    def density(self, left, right, top, bottom):
+        '''
+        DensityMap of a world rectangle from the cached tiles, stale
+        ones included.
+        '''
+        tiles = set()
+        known = []
+        with self.lock:
+            # one square of margin, for the anchors on the edges
+            for key in self.keys(left - 1, right + 1, top + 1, bottom - 1):
+                if key in self.chunks:
+                    tiles.update(self.chunks[key][1])
+                    known.append(self.bounds([key]))
+        return DensityMap(left, right, top, bottom, tiles, known)
+
+    def board(self, left, top, width=WIDTH, height=HEIGHT):
+        '''
+        Stitch the Board with its top left square at (left, top), None
+        while part of it has never been fetched.
+        '''
+        right = left + width - 1
+        bottom = top - height + 1
+        board = Board(left, top, width, height)
+        with self.lock:
+            for key in self.keys(left, right, top, bottom):
+                if key not in self.chunks:
+                    return None
+                for (x, y), letter in self.chunks[key][1].iteritems():
+                    if left <= x <= right and bottom <= y <= top:
+                        board.tiles[board.index(x - left, top - y)] = letter
+        return board
+
+
+class DensityMap(object):
+    '''
+    Summed-area tables of the known squares (those of fetched chunks),
+    the filled squares and the anchors (empty squares next to a tile)
+    over a world rectangle.
+
+    Counts over any region inside it take four lookups per table.
+    '''
+
+    def __init__(self, left, right, top, bottom, tiles, known):
+        self.left = left
+        self.right = right
+        self.top = top
+        self.bottom = bottom
+        self.width = right - left + 1
+        self.height = top - bottom + 1
+        filled = [0] * (self.width * self.height)
+        anchors = [0] * (self.width * self.height)
+        squares = [0] * (self.width * self.height)
+        for chunk_left, chunk_right, chunk_top, chunk_bottom in known:
+            for y in xrange(max(chunk_bottom, bottom),
+                    min(chunk_top, top) + 1):
+                for x in xrange(max(chunk_left, left),
+                        min(chunk_right, right) + 1):
+                    squares[self.index(x, y)] = 1
+        for x, y in tiles:
+            if self.inside(x, y):
+                filled[self.index(x, y)] = 1
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if self.inside(nx, ny) and (nx, ny) not in tiles:
+                    anchors[self.index(nx, ny)] = 1
+        self.known = self.table(squares)
+        self.filled = self.table(filled)
+        self.anchors = self.table(anchors)
+
+    def inside(self, x, y):
+        return self.left <= x <= self.right and self.bottom <= y <= self.top
+
+    def index(self, x, y):
+        return (self.top - y) * self.width + x - self.left
+
+    def table(self, grid):
+        '''
+        Summed-area table of a grid, with a zero row and column in front.
+        '''
+        width = self.width + 1
+        table = [0] * (width * (self.height + 1))
+        for row in xrange(self.height):
+            total = 0
+            for column in xrange(self.width):
+                total += grid[row * self.width + column]
+                table[(row + 1) * width + column + 1] = \
+                    table[row * width + column + 1] + total
+        return table
+
+    def _sum(self, table, left, right, top, bottom):
+        width = self.width + 1
+        left = max(left, self.left) - self.left
+        right = min(right, self.right) - self.left + 1
+        top = self.top - min(top, self.top)
+        bottom = self.top - max(bottom, self.bottom) + 1
+        if left >= right or top >= bottom:
+            return 0
+        return table[bottom * width + right] - table[top * width + right] - \
+            table[bottom * width + left] + table[top * width + left]
+
+    def count(self, left, right, top, bottom):
+        '''
+        Get (known, filled, anchors) of a world rectangle, clipped to the
+        map.
+        '''
+        return (self._sum(self.known, left, right, top, bottom),
+            self._sum(self.filled, left, right, top, bottom),
+            self._sum(self.anchors, left, right, top, bottom))
+
+
 class WordsquaredPlayer(object):
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, lexicon=None):
         '''
         Boo-yah!
         '''
-        self.username = USERNAME
-        self.password = PASSWORD
-        self.headers = {'User-Agent': USER_AGENT}
-        self.cookies = {}
+        self.username = username
+        self.password = password
+        self.lexicon = lexicon or LEXICON
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.headers = self.session.headers
+        self.headers['User-Agent'] = USER_AGENT
+        self.headers['Origin'] = WSQD
+        self.headers['Referer'] = '%s/' % WSQD
+        self.headers['X-Requested-With'] = 'XMLHttpRequest'
+        self.cookies = self.session.cookies
         self.authenticity_token = None
+        self.cache = ChunkCache()
         self.request = self._get(WSQD)
-        self.cookies = self.request.cookies
         pattern = re.compile('name="csrf-token" content="(.*?)"/>')
         self.authenticity_token = str(pattern.findall(self.request.text)[0])
+        self.headers['X-CSRF-Token'] = self.authenticity_token
         self.payload = {
             'utf8': '✓',
             'authenticity_token': self.authenticity_token,
@@ -550,45 +2509,49 @@ class WordsquaredPlayer(object):
         self.response = json.loads(self.request.text)
         self.game_id = str(self.response['gameId'])
 
+    def _endpoint(self, URL):
+        '''
+        Name an endpoint for the stats, counting the request.
+        '''
+        name = 'http%s' % urlparse.urlparse(URL).path.replace('/', '_')
+        if STATS is not None:
+            STATS.count(name)
+        return name
+
+    def _send(self, method, URL, **kwargs):
+        '''
+        Send a request on the session, within the in-flight limit shared
+        by every player of the process.
+        '''
+        with timed('in_flight_wait'):
+            IN_FLIGHT.acquire()
+        try:
+            with timed(self._endpoint(URL)):
+                return self.session.request(method, URL,
+                    #config=REQUESTS_CONFIG,
+                    timeout=TIMEOUT, **kwargs)
+        finally:
+            IN_FLIGHT.release()
+
     def _get(self, URL, payload=None):
         '''
-        Simple wrapper for requests.get().
+        Simple wrapper for Session.get().
+
+        Headers and cookies live on the session, which keeps the
+        connection to the server alive between requests.
         '''
         self.payload = payload
-        self.headers['Origin'] = WSQD
-        self.headers['Referer'] = '%s/' % WSQD
-        if self.authenticity_token:
-            self.headers['X-CSRF-Token'] = self.authenticity_token
-        self.headers['X-Requested-With'] = 'XMLHttpRequest'
-        self.request = requests.get(
-            URL, params=self.payload,
-            headers=self.headers,
-            cookies=self.cookies,
-            #config=REQUESTS_CONFIG,
-            timeout=TIMEOUT)
-        self.cookies = self.request.cookies
+        self.request = self._send('GET', URL, params=self.payload)
         return self.request
 
     def _post(self, URL, payload=None):
         '''
-        Simple wrapper for requests.post().
+        Simple wrapper for Session.post().
         '''
         self.payload = payload
-        self.headers['Origin'] = WSQD
-        self.headers['Referer'] = '%s/' % WSQD
-        if self.authenticity_token:
-            self.headers['X-CSRF-Token'] = self.authenticity_token
-        self.headers['X-Requested-With'] = 'XMLHttpRequest'
-        self.cookies['repeatCustomer'] = 'true'
-        self.cookies['newsViewed'] = 'true'
-        self.request = requests.post(
-            URL,
-            data=self.payload,
-            headers=self.headers,
-            cookies=self.cookies,
-            #config=REQUESTS_CONFIG,
-            timeout=TIMEOUT)
-        self.cookies = self.request.cookies
+        self.cookies.set('repeatCustomer', 'true')
+        self.cookies.set('newsViewed', 'true')
+        self.request = self._send('POST', URL, data=self.payload)
         return self.request
 
     def load_game(self):
@@ -621,36 +2584,98 @@ class WordsquaredPlayer(object):
         '''
         Fetch the board.
         '''
-        global LEFT
-        global TOP
         self.gx = gx
         self.gy = gy
         self.left = (self.gx - MEDIAN_WIDTH)
         self.right = (self.gx + MEDIAN_WIDTH)
         self.top = (self.gy + MEDIAN_HEIGHT)
         self.bottom = (self.gy - MEDIAN_HEIGHT)
-        TOP = (13 - (self.top % 14))
-        LEFT = (self.left % 14)
-        self.payload = {
+        self.board = self.fetch_board(gx, gy)
+        return self.board
+
+    def fetch_board(self, gx, gy):
+        '''
+        Fetch the board centred on (gx, gy).
+        '''
+        return self.fetch_boards([(gx, gy)])[0]
+
+    def fetch_boards(self, centres, stale=True):
+        '''
+        Fetch the boards centred on each (gx, gy) through the chunk cache.
+
+        Only missing or stale chunks are requested, one request per board
+        at most, issued at once over the session's connection pool. With
+        stale False, chunks fetched before are used up to CHUNK_MAX_AGE. The
+        player state is left alone. A board is None if its fetch failed.
+        '''
+        claimed = set()
+        fetches = []
+        for gx, gy in centres:
+            keys = self.cache.keys(gx - MEDIAN_WIDTH, gx + MEDIAN_WIDTH,
+                gy + MEDIAN_HEIGHT, gy - MEDIAN_HEIGHT)
+            keys = [key for key in (self.cache.stale(keys) if stale
+                    else self.cache.missing(keys))
+                if key not in claimed]
+            claimed.update(keys)
+            if keys:
+                fetches.append(keys)
+        if len(fetches) > 1:
+            for fetched, stats in get_fetch_pool().map(
+                    self._fetch_task, fetches):
+                if stats is not None:
+                    STATS.merge(stats)
+        elif fetches:
+            self.fetch_chunks(fetches[0])
+        return [self.cache.board(gx - MEDIAN_WIDTH, gy + MEDIAN_HEIGHT)
+            for gx, gy in centres]
+
+    def _fetch_task(self, keys):
+        '''
+        Pool task: fetch_chunks, handing what it counted on the pool
+        thread back to the calling game.
+        '''
+        if STATS is None:
+            return self.fetch_chunks(keys), None
+        STATS.reset()
+        fetched = self.fetch_chunks(keys)
+        stats = Stats()
+        stats.merge(STATS)
+        return fetched, stats
+
+    def fetch_area(self, left, right, top, bottom):
+        '''
+        Fetch a Board over any world rectangle through the chunk cache.
+
+        Moves generated on it may span what would be several viewports;
+        move coordinates are relative to board.left and board.top.
+        '''
+        keys = self.cache.stale(self.cache.keys(left, right, top, bottom))
+        if keys:
+            self.fetch_chunks(keys)
+        return self.cache.board(
+            left, top, right - left + 1, top - bottom + 1)
+
+    def fetch_chunks(self, keys):
+        '''
+        Fetch the rectangle covering chunks into the cache.
+        '''
+        left, right, top, bottom = self.cache.bounds(keys)
+        payload = {
             'game': self.game_id,
-            'left': self.left,
-            'right': self.right,
-            'top': self.top,
-            'bottom': self.bottom}
-        self.request = self._get('%s/v2/tiles_for' % WSQD,
-            payload=self.payload)
-        self.response = json.loads(self.request.text)
-        if self.response['result'] == 'success':
-            self.board = Board()
-            for tile in range(len(self.response['tiles'])):
-                self.x = self.response['tiles'][tile]['x'] - self.left
-                self.y = self.top - self.response['tiles'][tile]['y']
-                self.letter = self.response['tiles'][tile]['letter']
-                self.board.tiles[self.board.index(self.x, self.y)] = \
-                    str(self.letter).lower()
-            return self.board
-        else:
-            return None
+            'left': left,
+            'right': right,
+            'top': top,
+            'bottom': bottom}
+        fetched = time.time()
+        request = self._send('GET', '%s/v2/tiles_for' % WSQD, params=payload)
+        response = json.loads(request.text)
+        if response['result'] != 'success':
+            return False
+        self.cache.store(self.cache.keys(left, right, top, bottom),
+            [(tile['x'], tile['y'], str(tile['letter']).lower())
+                for tile in response['tiles']],
+            fetched)
+        return True
 
     def drag(self, payload=None):
         '''
@@ -674,7 +2699,16 @@ class WordsquaredPlayer(object):
         self.request = self._post('%s/v2/play' % WSQD, payload=self.payload)
         self.response = json.loads(self.request.text)
         self.status = self.response['result']
+        tiles = []
+        seq = 0
+        while 'tiles[%d][letter]' % seq in payload:
+            tiles.append((
+                payload['tiles[%d][x]' % seq],
+                payload['tiles[%d][y]' % seq],
+                payload['tiles[%d][letter]' % seq]))
+            seq += 1
         if self.status == 'success':
+            self.cache.patch(tiles)
             self.shortlink = self.response['shortlink']
             self.score = self.response['move_score']
             self.rack = self.response['assigned_letters']
@@ -694,6 +2728,9 @@ class WordsquaredPlayer(object):
                 'word_packs': self.word_packs}
         else:
             self.message = self.response['message']
+            if 'already exists' in self.message:
+                # someone else played there, refetch those chunks
+                self.cache.invalidate([(x, y) for x, y, letter in tiles])
             return {'status': self.status, 'message': self.message}
 
     def swap_rack(self):
@@ -709,6 +2746,11 @@ class WordsquaredPlayer(object):
     def location_shift(self, gx=None, gy=None):
         '''
         Shift to new location when the automated play is stuck.
+
+        The eight neighbouring regions are scored on a DensityMap of the
+        cached tiles. Only the chunks not held are requested, at once over
+        the fetch pool; stale ones are good enough to choose. Squares
+        that still could not be fetched do not count as free.
         '''
         self.gx = gx
         self.gy = gy
@@ -737,20 +2779,27 @@ class WordsquaredPlayer(object):
         self.area['E'] = {
             'gx': self.gx + MEDIAN_WIDTH,
             'gy': self.gy}
-        for location in ['NW', 'SW', 'NE', 'SE', 'N', 'S', 'W', 'E']:
-            self.area[location][EMPTY] = collections.Counter(
-                self.tiles_for(
-                    gx=self.area[location]['gx'],
-                    gy=self.area[location]['gy']).tiles)[EMPTY]
+        self.fetch_boards([(self.gx, self.gy)] + [
+                (area['gx'], area['gy']) for area in self.area.itervalues()],
+            stale=False)
+        density = self.cache.density(
+            self.gx - 2 * MEDIAN_WIDTH, self.gx + 2 * MEDIAN_WIDTH,
+            self.gy + 2 * MEDIAN_HEIGHT, self.gy - 2 * MEDIAN_HEIGHT)
+        for area in self.area.itervalues():
+            known, filled, area['anchors'] = density.count(
+                area['gx'] - MEDIAN_WIDTH, area['gx'] + MEDIAN_WIDTH,
+                area['gy'] + MEDIAN_HEIGHT, area['gy'] - MEDIAN_HEIGHT)
+            area[EMPTY] = known - filled
+        # An area without anchors has nowhere to play, unless all are so
         self.area = sorted(
-            self.area.iteritems(),
-            key=operator.itemgetter(1),
+            [item for item in self.area.iteritems() if item[1]['anchors']]
+                or self.area.items(),
+            key=lambda item: (item[1][EMPTY], item[1]['anchors']),
             reverse=True)
         # Sample:
-        # self.area = [('NE', {'.': 165, 'gx': 15, 'gy': 15}),
-        #              ('SW', {'.': 107, 'gx': 5, 'gy': 5}),
+        # self.area = [('NE', {'.': 865, 'anchors': 12, 'gx': 15, 'gy': 15}),
+        #              ('SW', {'.': 807, 'anchors': 40, 'gx': 5, 'gy': 5}),
         #         ...
-        # XXX: Exclude the area[0], sometime it's just an empty area.
         self.random_area = random.choice(self.area[0:5])
         return (
             self.random_area[0],
@@ -767,120 +2816,167 @@ class GiveMeABreak(Exception):
         return repr(self.value)
 
 
-if __name__ == '__main__':
-    STUCK = 0
-    FALLBACK = False
-    CROWDED = False
-    MAX_FILLED = BOARD_SIZE - (BOARD_SIZE/2)
-    WALKS = 0
+class Game(object):
+    '''
+    Play loop of one account.
+
+    Everything that changes between turns lives on the instance, so any
+    number of games can share the process, its lexicons and move cache.
+    '''
+
+    MAX_FILLED = BOARD_SIZE - (BOARD_SIZE / 2)
     MAX_WALKS = ODD_NUMBER * 2
 
-    # Login
-    bot = WordsquaredPlayer(USERNAME, PASSWORD)
-    logger.debug('Logged in as "%s".' % USERNAME)
+    def __init__(self, bot):
+        self.bot = bot
+        self.logger = logger.getChild(bot.username)
+        self.stuck = 0
+        self.fallback = False
+        self.crowded = False
+        self.walks = 0
+        self.start = START
+        self.looking_for_long_words = True
+        self.long_words_error = False
+        self.word_packs_error = False
+
+        # Load game
+        self.load_game()
 
-    # Load game
-    load_game = bot.load_game()
-    rack = load_game['rack']
-    shortlink = load_game['shortlink']
-    gx = load_game['gx']
-    gy = load_game['gy']
-    word_packs = load_game['word_packs']
+        # Load board
+        self.board = bot.tiles_for(gx=self.gx, gy=self.gy)
 
-    # Load board
-    board = bot.tiles_for(gx=gx, gy=gy)
+    def load_game(self):
+        load_game = self.bot.load_game()
+        self.rack = load_game['rack']
+        self.shortlink = load_game['shortlink']
+        self.gx = load_game['gx']
+        self.gy = load_game['gy']
+        self.word_packs = load_game['word_packs']
+
+    def run(self):
+        while True:
+            self.turn()
+            if STATS is not None:
+                self.logger.info('Stats: %s' % json.dumps(
+                    STATS.record(), sort_keys=True))
+                STATS.reset()
+
+    def reload(self, board):
+        '''
+        Load the tiles of board, the window or an area, from the chunk
+        cache, fetching its stale chunks.
+        '''
+        board.load(self.bot.fetch_area(board.left,
+            board.left + board.width - 1, board.top,
+            board.top - board.height + 1).tiles)
 
-    LOOKING_FOR_LONG_WORDS = True
-    LONG_WORDS_ERROR = False
-    WORD_PACKS_ERROR = False
+    def search(self, board, letters):
+        '''
+        Get the moves to try on board, best first, and the number of
+        moves found.
 
-    while True:
+        Word packs are searched for directly, the full generation only
+        runs when none can be formed. Long words are few and spread over
+        the whole lexicon, so they are kept aside from the moves of the
+        full generation instead; both are memoised in MOVE_CACHE.
+        '''
+        bot = self.bot
+        logger = self.logger
+        with timed('generate'):
+            if self.word_packs and not self.word_packs_error:
+                top = TopMoves(TOP_MOVES)
+                top.extend(iter_target_moves(board, letters,
+                    self.word_packs, lexicon=bot.lexicon))
+                if top.count:
+                    logger.debug('Found some words from word packs.')
+                    return top.moves(), top.count
+            moves, long_words, count = search_moves(board, letters,
+                TOP_MOVES, bot.lexicon)
+        if long_words and self.looking_for_long_words and \
+                not self.long_words_error:
+            logger.debug('Found some long words.')
+            return long_words, count
+        return moves, count
+
+    def turn(self):
+        bot = self.bot
+        logger = self.logger
         try:
-            if CROWDED or FALLBACK:
-                CROWDED = False
-                if FALLBACK:
-                    load_game = bot.load_game()
-                    rack = load_game['rack']
-                    shortlink = load_game['shortlink']
-                    gx = load_game['gx']
-                    gy = load_game['gy']
-                    word_packs = load_game['word_packs']
+            if self.crowded or self.fallback:
+                self.crowded = False
+                if self.fallback:
+                    self.load_game()
                     logger.debug('Fallback.')
-                (location, gx, gy) = bot.location_shift(gx=gx, gy=gy)
-                START = LOCATION_START[location]
+                (location, self.gx, self.gy) = bot.location_shift(
+                    gx=self.gx, gy=self.gy)
+                self.start = LOCATION_START[location]
                 #time.sleep(1)
-                board = bot.tiles_for(gx=gx, gy=gy)
-                error_coords = []
-                logger.debug('Moving to %s (%d, %d).' % (location, gx, gy))
+                self.board = bot.tiles_for(gx=self.gx, gy=self.gy)
+                self.board.start = self.start
+                logger.debug('Moving to %s (%d, %d).' % (
+                    location, self.gx, self.gy))
 
                 # Apparently, there's no need to swap the rack.
                 # Will keep this for historical reason.
-                #rack = bot.swap_rack()['assigned_letters']
+                #self.rack = bot.swap_rack()['assigned_letters']
                 #logger.debug('Got stuck. Swap the rack.')
 
             # Don't be too greedy
             #time.sleep(3)
-            #board = bot.tiles_for(gx=gx, gy=gy)
+            #self.board = bot.tiles_for(gx=self.gx, gy=self.gy)
 
-            area_empty = collections.Counter(board.tiles)[EMPTY]
+            board = self.board
+            area_empty = board.count_empty()
             area_filled = len(board.tiles) - area_empty
-            
-            if area_filled >= MAX_FILLED or WALKS >= MAX_WALKS:
-                CROWDED = True
+
+            if area_filled >= self.MAX_FILLED or \
+                self.walks >= self.MAX_WALKS:
+                self.crowded = True
                 raise GiveMeABreak(
                     'Too crowded or maximum walks reached.'
                     ' Empty: %d, Limit: %d, Total: %d.' % \
-                        (area_empty, MAX_FILLED, len(board.tiles)))
+                        (area_empty, self.MAX_FILLED, len(board.tiles)))
 
             # Lazy hack to get seven letters of O, I, T, A, E
-            #rack = [letter.upper() for letter in rack]
-            #if ''.join(set(rack)) == 'E':
-            #    logger.debug('You have seven %s in your rack' % rack[0])
+            #self.rack = [letter.upper() for letter in self.rack]
+            #if ''.join(set(self.rack)) == 'E':
+            #    logger.debug('You have seven %s in your rack' % self.rack[0])
             #    sys.exit(1)
-            #for i in xrange(len(rack)):
-            #    if 'E' in rack:
-            #        rack.remove('E')
-
-            moves = generate_moves(board,
-                [letter.lower() for letter in rack])
-            len_moves = len(moves)
+            #for i in xrange(len(self.rack)):
+            #    if 'E' in self.rack:
+            #        self.rack.remove('E')
+
+            letters = [letter.lower() for letter in self.rack]
+            moves, len_moves = self.search(board, letters)
+
+            if not len_moves and AREA_MARGIN:
+                # Moves crossing the border of the window are only found
+                # on a board stitched around it; try them before moving.
+                area = bot.fetch_area(board.left - AREA_MARGIN,
+                    board.left + board.width - 1 + AREA_MARGIN,
+                    board.top + AREA_MARGIN,
+                    board.top - board.height + 1 - AREA_MARGIN)
+                if area is not None:
+                    moves, len_moves = self.search(area, letters)
+                    if len_moves:
+                        logger.debug('Playing around the window.')
+                        board = area
 
             if not len_moves:
-                FALLBACK = True
+                self.fallback = True
                 raise GiveMeABreak('Zero move.')
 
-            # find word in word packs or long words
-            if word_packs or LOOKING_FOR_LONG_WORDS:
-                word_packs_moves = []
-                long_words_moves = []
-                for i in xrange(len_moves):
-                    for word in moves[i].words:
-                        if len(word) >= 14:
-                            long_words_moves.append(moves[i])
-                        if word in word_packs:
-                            word_packs_moves.append(moves[i])
-                if long_words_moves and not LONG_WORDS_ERROR:
-                    moves = long_words_moves
-                    moves.sort(key=lambda x: x.key)
-                    logger.debug('Found some long words.')
-                if word_packs_moves and not WORD_PACKS_ERROR:
-                    moves = word_packs_moves
-                    moves.sort(key=lambda x: x.key)
-                    logger.debug('Found some words from word packs.')
-
-            moves.sort(key=lambda x: x.key)
             logger.debug(
                 'Working on (%d, %d).'
                 ' There are %d possible %s.'
                 ' Current rack: %s.' % (
-                    gx, gy, len_moves, 'moves' if len_moves >= 2 else 'move',
-                    ''.join(rack)))
-
-            for i in xrange(len_moves):
-                move = moves[i]
-                left = (gx - MEDIAN_WIDTH)
-                top = (gy + MEDIAN_HEIGHT)
-                coordinate = {'x': left + move.x, 'y': top - move.y}
+                    self.gx, self.gy, len_moves,
+                    'moves' if len_moves >= 2 else 'move',
+                    ''.join(self.rack)))
+
+            for move in moves:
+                coordinate = {
+                    'x': board.left + move.x, 'y': board.top - move.y}
                 (cx, cy) = (coordinate['x'], coordinate['y'])
                 (dx, dy) = DIRECTION[move.direction]
 
@@ -908,15 +3004,18 @@ if __name__ == '__main__':
                 play = bot.play(payload=dict_play)
 
                 if play['status'] == 'success':
-                    board.do_move(move)
-                    STUCK = 0
-                    FALLBACK = False
-                    WORD_PACKS_ERROR = False
-                    LONG_WORDS_ERROR = False
-                    WALKS += 1
-
-                    rack = play['rack']
-                    word_packs = play['word_packs']
+                    # as the chunk cache holds it: blanks are not told
+                    # apart on the world board
+                    board.do_move(Move(move.x, move.y, move.direction,
+                        move.tiles.lower(), move.score, move.words))
+                    self.stuck = 0
+                    self.fallback = False
+                    self.word_packs_error = False
+                    self.long_words_error = False
+                    self.walks += 1
+
+                    self.rack = play['rack']
+                    self.word_packs = play['word_packs']
                     logger.info(
                         '(%d, %d) "%s" %s - Direction: %s - Score: %s.' % (
                             coordinate['x'], coordinate['y'],
@@ -927,16 +3026,12 @@ if __name__ == '__main__':
                     break
                 else:
                     board.undo_move(move)
-                    word_packs_error = []
-                    long_words_error = []
 
                     for word in move.words:
-                        if len(word) >= 14:
-                            long_words_error.append(word)
-                            LONG_WORDS_ERROR = True
-                        if word in word_packs:
-                            word_packs_error.append(word)
-                            WORD_PACKS_ERROR = True
+                        if len(word) >= LONG_WORD:
+                            self.long_words_error = True
+                        if word in self.word_packs:
+                            self.word_packs_error = True
                     logger.error(
                         '(%d, %d) "%s" %s - %s' % (
                             coordinate['x'], coordinate['y'],
@@ -954,15 +3049,19 @@ if __name__ == '__main__':
                     #   existing tile
                     if 'must play' in play['message']:
                         # Placed the tiles on empty area. Not accepted.
-                        FALLBACK = True
-                        STUCK += 1
+                        self.fallback = True
+                        self.stuck += 1
 
                     # - You tried to place a tile where one already exists.
+                    # There's another player on the same area: play()
+                    # dropped the chunks of our tiles, reload them. If the
+                    # board changed, the other moves are stale as well.
+                    changed = False
                     if 'already exists' in play['message']:
-                        # There's another player on the same area
-                        # Reload the board
-                        board = bot.tiles_for(gx=gx, gy=gy)
-                        STUCK += 1
+                        self.stuck += 1
+                        tiles = list(board.tiles)
+                        self.reload(board)
+                        changed = board.tiles != tiles
 
                     # The following errors are ignored. Will keep trying until
                     # reaching the limit.
@@ -972,12 +3071,19 @@ if __name__ == '__main__':
                     # - 0 move.
                     if 'non-gray' in play['message'] or \
                         'not a valid word' in play['message']:
-                        STUCK += 1
+                        self.stuck += 1
 
-                    if STUCK >= ODD_NUMBER:
-                        FALLBACK = True
+                    if self.stuck >= ODD_NUMBER:
+                        self.fallback = True
                         break
 
+                    if changed:
+                        break
+
+            if board is not self.board:
+                # the area holds our play, bring the window up to date
+                self.reload(self.board)
+
         except KeyboardInterrupt:
             sys.exit(1)
         except EOFError:
@@ -990,5 +3096,48 @@ if __name__ == '__main__':
                 traceback.print_exc()
                 sys.exit(1)
             else:
-                FALLBACK = True
+                self.fallback = True
                 time.sleep(10)
+
+
+def play_account(username, password, lexicon=None):
+    '''
+    Log in and play one account until the process ends.
+    '''
+    try:
+        bot = WordsquaredPlayer(username, password, lexicon)
+        logger.debug('Logged in as "%s".' % username)
+        Game(bot).run()
+    except Exception, e:
+        logger.error('%s: %s' % (username, e))
+        if DEBUG and DEBUG_LEVEL >= 2:
+            traceback.print_exc()
+
+
+def play_accounts(accounts, lexicon=None):
+    '''
+    Play every (username, password) account on a thread of its own.
+
+    The threads share the mapped lexicons, the move cache and the worker
+    pool; requests are capped by MAX_IN_FLIGHT over all of them.
+    '''
+    if PROCESSES > 1:
+        get_dawg(lexicon)
+        get_pool(PROCESSES)
+    if len(accounts) == 1:
+        return play_account(accounts[0][0], accounts[0][1], lexicon)
+    threads = []
+    for username, password in accounts:
+        thread = threading.Thread(target=play_account,
+            args=(username, password, lexicon), name=username)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # join() with no timeout would block KeyboardInterrupt
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    play_accounts(ACCOUNTS)